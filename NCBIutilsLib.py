@@ -27,6 +27,21 @@ Author: Jim
 # NOTICE RETTYPE VS RETMODE, see below... 
 #      this confused the heck out of me for hours
 
+(3) count, webenv = doSearch('pubmed', query, URLReader=URLReader)
+    for retstart, output in getResultsBatches('pubmed', webenv, count,
+                                    op='fetch', rettype='medline',
+                                    retmode='text', URLReader=URLReader):
+        # output is a batch of (up to) 10000 records starting at retstart
+        # if this dies, restart the loop with retstart=last retstart+10000
+    # or fetch 4 windows at a time (still in order, within the throttle):
+    for retstart, output in getResultsBatches('pubmed', webenv, count,
+                                    op='fetch', numThreads=4,
+                                    URLReader=surl.ThrottledURLReader(0.1)):
+
+(4) count, output, webenv = getSearchResults('pubmed', query, op='fetch')
+    for article in iterXMLRecords(output):	# one PubmedArticle at a time
+        pmid = article.findtext('MedlineCitation/PMID')
+
 *** Eutils Docs ***
 https://www.ncbi.nlm.nih.gov/books/NBK25501/
 https://www.ncbi.nlm.nih.gov/books/NBK3827/#pubmedhelp.How_do_I_search_by_journal_na
@@ -84,8 +99,10 @@ Version 2.0 esummary output:
     https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20160609/esummary_pmc.dtd
 """
 import sys
-import xml.dom.minidom as minidom	# try to use things in python 2.4
-#import xml.etree.ElementTree as et
+import collections
+import concurrent.futures
+import urllib.parse
+import xml.etree.ElementTree as et
 #import json
 import simpleURLLib as surl
 
@@ -107,12 +124,139 @@ ID_CONVERTER_URL = ESEARCH_BASE + '&db=pubmed&term=%s[lid]'
 
 USEHISTORY = "&usehistory=y"	# eutils param for history
 
+# retry transient eutils failures (429 too many requests, 5xx, network)
+EUTILS_RETRY_POLICY = surl.RetryPolicy(maxAttempts=5, backoff=2.0)
+
+# default URLReaders for the functions below. All the functions share these,
+#  so they share one throttle and one retry policy.
+defaultURLReader = surl.ThrottledURLReader(retryPolicy=EUTILS_RETRY_POLICY)
+defaultAsyncURLReader = surl.AsyncURLReader(
+                            limiter=defaultURLReader.limiter,
+                            retryPolicy=EUTILS_RETRY_POLICY)
+
+POST_BATCH_SIZE = 10000		# default num of IDs per epost in doPostBatches()
+
 DEFAULT_ENCODING = 'utf-8'      # to use when creating URLs
+
+# ttls (seconds) for simpleURLLib.ResponseCache, e.g.,
+#   URLReader = surl.ThrottledURLReader(cache=surl.ResponseCache(
+#                           '/some/dir', ttls=EUTILS_CACHE_TTLS))
+# esearch and epost results are never cached: they create new result sets
+#   on the history server (which expire), and esummary/efetch URLs that
+#   use those webenvs won't repeat from run to run. Requests by ID (see
+#   getIdResults()) are what get cache hits.
+EUTILS_CACHE_TTLS = {
+                'esearch.fcgi'  : 0,
+                'epost.fcgi'    : 0,
+                'esummary.fcgi' : 24*60*60,
+                'efetch.fcgi'   : 24*60*60,
+                }
+
+XML_CHUNK_SIZE = 4096           # bytes fed to the XML parser at a time
+
+# tags of the individual records in esummary/efetch XML output
+RECORD_TAGS = ('PubmedArticle', 'PubmedBookArticle',	# pubmed efetch
+                'DocumentSummary',	# esummary version 2.0
+                'DocSum',		# esummary version 1.0
+                'article',		# pmc efetch
+                )
+# -------------------------
+
+def iterXMLChunks(output,	# XML as bytes or str, or file-like object
+                                #  or iterable of bytes chunks
+                chunkSize=XML_CHUNK_SIZE,
+            ):
+    """ Generator: yield the XML output in chunks to feed to a parser
+    """
+    if type(output) == type(' '):
+        output = output.encode(DEFAULT_ENCODING)
+    if type(output) == type(b' '):
+        view = memoryview(output)
+        for i in range(0, len(output), chunkSize):
+            yield view[i:i+chunkSize]
+    elif hasattr(output, 'read'):
+        while True:
+            chunk = output.read(chunkSize)
+            if not chunk: break
+            yield chunk
+    else:
+        for chunk in output:
+            yield chunk
+# -------------------------
+
+def parseHeaderFields(output,	# eutils XML output, see iterXMLChunks()
+                tags=('Count', 'WebEnv', 'QueryKey'),
+            ):
+    """ Return dict {tag: text} of the first element with each tag in
+            the XML output. Tags that are not found are not in the dict.
+        Stops parsing as soon as all the tags are found, so for esearch and
+            epost output only the first few KB are looked at.
+    """
+    fields = {}
+    parser = et.XMLPullParser(events=('end',))
+    for chunk in iterXMLChunks(output):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if elem.tag in tags and elem.tag not in fields:
+                fields[elem.tag] = elem.text
+        if len(fields) == len(tags): break
+    return fields
+# -------------------------
+
+def getHeaderWebenv(output,	# eutils XML output, see iterXMLChunks()
+                    op='esearch',	# name of the eutil, for error msgs
+                    count=False,	# also get the Count
+            ):
+    """ Parse out the webenv and query_key params (and the Count, if asked)
+            from the start of eutils XML output.
+        Return (webenv, query_key) or (count, webenv, query_key)
+    """
+    tags = ('Count', 'WebEnv', 'QueryKey') if count else ('WebEnv','QueryKey')
+    fields = parseHeaderFields(output, tags=tags)
+    if len(fields) != len(tags):
+        if hasattr(output, 'read'): output = b''	# already consumed
+        raise Exception('Could not find %s in %s output:\n%s\n' % \
+                    (', '.join(tags), op, output[:500]))
+    webenv, query_key = fields['WebEnv'], fields['QueryKey']
+    if count: return int(fields['Count']), webenv, query_key
+    return webenv, query_key
+# -------------------------
+
+def iterXMLRecords(output,	# eutils XML output, see iterXMLChunks()
+                recordTags=RECORD_TAGS,	# tags of the records to yield
+            ):
+    """ Generator: parse esummary/efetch XML output incrementally and yield
+            an ElementTree Element for each record, one at a time.
+        A record is an element w/ a tag in recordTags that is not inside
+            another record.
+        Each record is removed from the document after it is yielded, so
+            memory is bounded by the size of a record, not the output.
+            (So keep what you need from a record before asking for the next.)
+    """
+    parser = et.XMLPullParser(events=('start', 'end'))
+    parents = []		# stack of open elements
+    inRecord = 0		# number of open elements w/ a record tag
+    for chunk in iterXMLChunks(output):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag in recordTags: inRecord += 1
+                continue
+            parents.pop()
+            if elem.tag not in recordTags: continue
+            inRecord -= 1
+            if inRecord == 0:
+                yield elem
+                if parents: parents[-1].remove(elem)
+    parser.close()
 # -------------------------
 
 def getWebenv(root,	# minidom root of xml output a eutils
             ):
     """ Parse out the webenv and query_key params from eutils XML output
+        Legacy: kept for callers that already have a minidom DOM; the
+        functions here use getHeaderWebenv() instead.
     """
     			# I'm no dom expert, maybe there's a better way?
     query_key = root.getElementsByTagName("QueryKey")[0].childNodes[0].data
@@ -129,27 +273,113 @@ def codeWebenvURLParams(webenv,
     return "&webenv=%s&query_key=%s" % (webenv, query_key)
 # -------------------------
 
+def decodeWebenvURLParams(webenvURLParams,
+            ):
+    """ Return (webenv, query_key) from codeWebenvURLParams() output
+    """
+    params = dict(urllib.parse.parse_qsl(webenvURLParams))
+    return params['webenv'], params['query_key']
+# -------------------------
+
+def uniqueIds(ids,	# list (or iterable) of IDs (str, bytes, or other)
+            ):
+    """ Return list of the IDs as bytes, stripped, w/ duplicates removed
+            (keeping the first occurrence of each)
+    """
+    return list(dict.fromkeys( [toBytes(x).strip() for x in ids] ))
+# -------------------------
+
+def toBytes(x):
+    """ Return x (bytes, str, or other) as bytes
+    """
+    if type(x) == type(b' '): return x
+    if type(x) == type(' '): return x.encode(encoding=DEFAULT_ENCODING)
+    else:                    return str(x).encode(encoding=DEFAULT_ENCODING)
+# -------------------------
+
+def buildSearchURL(db,		# eutils db name ('pubmed', 'pmc', ...)
+            queryString,	# esearch query string
+    ):
+    """ Return the esearch URL that leaves the results on the history server
+    """
+    return ESEARCH_BASE + "%s&db=%s&term=%s&retmode=%s" % \
+                                        (USEHISTORY, db, queryString,'xml')
+# -------------------------
+
+def buildPostParams(db,	# eutils db name ('pubmed', 'pmc', ...)
+            ids,	# list of IDs (str or bytes) to post
+            webenvURLParams=None,	# post to this webenv's history
+    ):
+    """ Return the epost params (bytes) to post to EPOST_BASE
+    """
+    idParams    = b','.join( [toBytes(x).strip() for x in ids] )
+    otherParams = b'api_key=%b&db=%b' %(toBytes(EUTILS_API_KEY),toBytes(db))
+    if webenvURLParams != None:
+        webenv, query_key = decodeWebenvURLParams(webenvURLParams)
+        otherParams += b'&WebEnv=%b' % toBytes(webenv)
+    return otherParams + b'&id=' + idParams
+# -------------------------
+
+def getResultsBaseURL(op='summary',	# 'summary' or 'fetch' output
+            retmode='xml',	# eutils desired output format
+    ):
+    """ Return the esummary or efetch base URL for op
+    """
+    if op == 'summary': url = ESUMMARY_BASE
+    elif op == 'fetch':
+        if retmode == 'json':
+            raise Exception('NCBI efetch does not support json return mode\n')
+        url = EFETCH_BASE
+    else: raise Exception('Invalid SearchResults operation: %s\n' % str(op))
+    return url
+# -------------------------
+
+def buildResultsURL(db,		# eutils db name ('pubmed', 'pmc', ...)
+                webenvURLParams,
+                op='summary',	# see getResults() for these params
+                retmode='xml',
+                rettype=None,
+                version='2.0',
+                retmax=None,
+                retstart=0,
+    ):
+    """ Return the esummary or efetch URL for results on the history server
+    """
+    # result type (could check for more option combination errors)
+    url = getResultsBaseURL(op, retmode)
+
+    url += webenvURLParams + \
+                "&db=%s&retmode=%s&version=%s" % (db, retmode, str(version))
+    if rettype != None:
+        url += "&rettype=%s" % rettype
+
+    if retmax == None or retmax == 0: retmax = 10000	# eutils XML max
+    if retmode == 'json':
+        url += "&retmax=%d" % min(retmax, 500)
+    else: url += "&retmax=%d" % retmax
+    if retstart:
+        url += "&retstart=%d" % retstart
+    return url
+# -------------------------
+
 def doSearch(db,		# eutils db name ('pubmed', 'pmc', ...)
             queryString,	# esearch query string
-            URLReader=surl.ThrottledURLReader(),
+            URLReader=defaultURLReader,
             debug=False,
     ):
     """ do a eutils.esearch & leave result set on the eutils history server.
         Return count and webenv/query_key (as URL params) on history server.
     """
     # do search, save results in eutils history - get search output in xml
-    url = ESEARCH_BASE + "%s&db=%s&term=%s&retmode=%s" % \
-                                        (USEHISTORY, db, queryString,'xml')
+    url = buildSearchURL(db, queryString)
     if debug: sys.stderr.write( "Esearch URL:\n%s\n" % url)
 
     outputX = URLReader.readURL(url) 
     if debug: sys.stderr.write( "Output from Esearch:\n%s\n" % outputX)
 
-    xmlDoc = minidom.parseString(outputX)	# what about errors?
-    count = int(xmlDoc.getElementsByTagName("Count")[0].childNodes[0].data)
-
-    # get webenv params
-    webenv, query_key = getWebenv(xmlDoc)
+    # get count and webenv params
+    count, webenv, query_key = getHeaderWebenv(outputX, op='esearch',
+                                                                count=True)
     webenvURLParams = codeWebenvURLParams(webenv, query_key)
 
     return count, webenvURLParams
@@ -157,19 +387,16 @@ def doSearch(db,		# eutils db name ('pubmed', 'pmc', ...)
 
 def doPost(db,		# eutils db name ('pubmed', 'pmc', ...)
             ids,	# list of IDs (str or bytes) to post and get fetch for
-            URLReader=surl.ThrottledURLReader(),
+            URLReader=defaultURLReader,
             debug=False,
+            webenvURLParams=None,	# if given, add the IDs to this
+                                        #  webenv's history (new query_key)
     ):
     """ do a eutils.post and return webenv/query_key as eutils URL params.
+        For very long ID lists, see doPostBatches()
     """
-    def toBytes(x):
-        if type(x) == type(b' '): return x
-        if type(x) == type(' '): return x.encode(encoding=DEFAULT_ENCODING)
-        else:                    return str(x).encode(encoding=DEFAULT_ENCODING)
     # build params for post
-    idParams    = b','.join( [toBytes(x).strip() for x in ids] )
-    otherParams = b'api_key=%b&db=%b&id=' %(toBytes(EUTILS_API_KEY),toBytes(db))
-    params = otherParams + idParams
+    params = buildPostParams(db, ids, webenvURLParams=webenvURLParams)
 
     url = EPOST_BASE
     if debug:
@@ -179,15 +406,37 @@ def doPost(db,		# eutils db name ('pubmed', 'pmc', ...)
     outputX = URLReader.readURL(url, params=params, GET=False) 
     if debug: sys.stderr.write( "Output from Epost:\n%s\n" % outputX[:100])
 
-    xmlDoc = minidom.parseString(outputX)
-
     # get webenv params
-    webenv, query_key = getWebenv(xmlDoc)
+    webenv, query_key = getHeaderWebenv(outputX, op='epost')
     webenvURLParams = codeWebenvURLParams(webenv, query_key)
 
     return webenvURLParams
 # -------------------------
 
+def doPostBatches(db,	# eutils db name ('pubmed', 'pmc', ...)
+            ids,	# list (or iterable) of IDs (str or bytes) to post
+            batchSize=POST_BATCH_SIZE,	# max num of IDs per epost
+                                # (None or 0 means POST_BATCH_SIZE)
+            URLReader=defaultURLReader,
+            debug=False,
+    ):
+    """ Generator: do a eutils.post for each batch of (up to) batchSize IDs.
+        Duplicate IDs are removed first.
+        All the batches are posted to the same webenv, each gets its own
+            query_key.
+        Yields (batch IDs (list of bytes), webenv/query_key as URL params)
+            for each batch as it is posted.
+    """
+    if batchSize == None or batchSize == 0: batchSize = POST_BATCH_SIZE
+    ids = uniqueIds(ids)
+    webenvURLParams = None
+    for start in range(0, len(ids), batchSize):
+        batch = ids[start:start+batchSize]
+        webenvURLParams = doPost(db, batch, webenvURLParams=webenvURLParams,
+                                        URLReader=URLReader, debug=debug)
+        yield batch, webenvURLParams
+# -------------------------
+
 def getResults(db,		# eutils db name ('pubmed', 'pmc', ...)
                 webenvURLParams,
                 op='summary',	# 'summary' or 'fetch' output
@@ -198,36 +447,148 @@ def getResults(db,		# eutils db name ('pubmed', 'pmc', ...)
                                 # None of 0 means no max.
                                 # 10000 is XML output max for eutils
                                 #   500 is json output max for eutils
-                URLReader=surl.ThrottledURLReader(),
+                URLReader=defaultURLReader,
                 debug=False,
+                retstart=0,	# index of first result to return (0-based)
     ):
     """ Do a eutils.esearch or efetch from results on history server 
             and return results (string)
         Retmode/rettype: see notes above
         Note: for json output, eutils have a 500 record output limit,
         and you get an eutils error if you don't have &retmax
+        To get more results than the eutils max, see getResultsBatches()
     """
-    # result type (could check for more option combination errors)
-    if op == 'summary': url = ESUMMARY_BASE
-    elif op == 'fetch':
-        if retmode == 'json':
-            raise Exception('NCBI efetch does not support json return mode\n')
-        url = EFETCH_BASE
-    else: raise Exception('Invalid SearchResults operation: %s\n' % str(op))
+    url = buildResultsURL(db, webenvURLParams, op=op, retmode=retmode,
+                    rettype=rettype, version=version, retmax=retmax,
+                    retstart=retstart)
 
-    url += webenvURLParams + \
-                "&db=%s&retmode=%s&version=%s" % (db, retmode, str(version))
-    if rettype != None:
-        url += "&rettype=%s" % rettype
+    if debug: sys.stderr.write( "Summary/Fetch URL:\n%s\n" % url )
 
-    if retmax == None or retmax == 0: retmax = 10000	# eutils XML max
-    if retmode == 'json':
-        url += "&retmax=%d" % min(retmax, 500)
-    else: url += "&retmax=%d" % retmax
+    output = URLReader.readURL(url)
+
+    return output
+# -------------------------
+
+def openResults(db,		# eutils db name ('pubmed', 'pmc', ...)
+                webenvURLParams,
+                op='summary',	# see getResults() for these params
+                retmode='xml',
+                rettype=None,
+                version='2.0',
+                retmax=None,
+                URLReader=defaultURLReader,
+                debug=False,
+                retstart=0,
+    ):
+    """ Like getResults(), but return a simpleURLLib.URLStream to read the
+            results from incrementally instead of the whole results string.
+            e.g., to parse them w/ iterXMLRecords() or save them w/
+            surl.writeStream(), in constant memory:
+        with openResults('pubmed', webenv, op='fetch') as stream:
+            for article in iterXMLRecords(stream): ...
+    """
+    url = buildResultsURL(db, webenvURLParams, op=op, retmode=retmode,
+                    rettype=rettype, version=version, retmax=retmax,
+                    retstart=retstart)
 
     if debug: sys.stderr.write( "Summary/Fetch URL:\n%s\n" % url )
 
-    output = URLReader.readURL(url)
+    return URLReader.openURL(url)
+# -------------------------
+
+def getResultsBatches(db,	# eutils db name ('pubmed', 'pmc', ...)
+                webenvURLParams,
+                count,		# number of results in the history server set
+                                #  (e.g., from doSearch())
+                op='summary',	# 'summary' or 'fetch' output
+                retmode='xml',	# eutils desired output format
+                rettype=None,	# eutils rettype option
+                version='2.0',	# eutils output version (affects json?)
+                batchSize=None,	# number of results per request.
+                                # None or 0 means the eutils max:
+                                #   10000 for XML (and text), 500 for json
+                retstart=0,	# index of first result to return (0-based)
+                                #  use this to resume after a failure
+                numThreads=1,	# number of windows to fetch in parallel
+                URLReader=defaultURLReader,
+                debug=False,
+    ):
+    """ Generator: walk the results on the history server in retstart
+            windows of batchSize, doing one esummary or efetch per window.
+        Yields (retstart, output) for each window, in retstart order, where
+            retstart is the index of the first result in output (string).
+        If numThreads > 1, up to numThreads windows are requested at once
+            so their round trips overlap. All requests go through the one
+            URLReader, so its throttle still sets the overall request rate
+            (e.g., use ThrottledURLReader(seconds=0.1) w/ an api_key).
+            At most numThreads windows are held in memory at a time.
+        If a request fails, the exception propagates. Restart by passing
+            the retstart of the window that failed (i.e., the last retstart
+            yielded + batchSize) - as long as the webenv has not expired
+            on the history server.
+    """
+    maxBatch = 500 if retmode == 'json' else 10000	# eutils maxes
+    if batchSize == None or batchSize == 0: batchSize = maxBatch
+    batchSize = min(batchSize, maxBatch)
+
+    def getWindow(start):
+        return getResults(db, webenvURLParams, op=op, retmode=retmode,
+                        rettype=rettype, version=version, retmax=batchSize,
+                        retstart=start, URLReader=URLReader, debug=debug)
+
+    starts = range(retstart, count, batchSize)
+    if numThreads <= 1:
+        for start in starts:
+            yield start, getWindow(start)
+        return
+
+    # keep numThreads windows in flight, yield them in order as they finish
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numThreads) as ex:
+        pending = collections.deque()
+        try:
+            for start in starts:
+                pending.append( (start, ex.submit(getWindow, start)) )
+                if len(pending) >= numThreads:
+                    start, future = pending.popleft()
+                    yield start, future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield start, future.result()
+        finally:	# failure or generator closed, don't start any more
+            for start, future in pending:
+                future.cancel()
+# -------------------------
+
+def getIdResults(db,		# eutils db name ('pubmed', 'pmc', ...)
+                ids,		# list of IDs (str or bytes) to get results for
+                op='summary',	# 'summary' or 'fetch' output
+                retmode='xml',	# eutils desired output format
+                rettype=None,	# eutils rettype option
+                version='2.0',	# eutils output version (affects json?)
+                URLReader=defaultURLReader,
+                debug=False,
+    ):
+    """ Do a eutils.esummary or efetch for the IDs directly (no history
+            server) and return results (string)
+        The IDs are POSTed, so the list can be long, but eutils will only
+            return up to 10000 (500 for json) results.
+        Unlike results from the history server, the same IDs make the same
+            request each time, so if URLReader has a ResponseCache (see
+            EUTILS_CACHE_TTLS), repeated requests are answered from it.
+    """
+    url = getResultsBaseURL(op, retmode)
+
+    params = b'db=%b&retmode=%b&version=%b' % \
+                        (toBytes(db), toBytes(retmode), toBytes(version))
+    if rettype != None:
+        params += b'&rettype=%b' % toBytes(rettype)
+    params += b'&id=' + b','.join( [toBytes(x).strip() for x in ids] )
+
+    if debug:
+        sys.stderr.write( "Summary/Fetch URL:\n%s\n" % url )
+        sys.stderr.write( "Summary/Fetch Params: \n'%s'\n" % params[:200])
+
+    output = URLReader.readURL(url, params=params, GET=False)
 
     return output
 # -------------------------
@@ -240,7 +601,7 @@ def getSearchResults(db,		# eutils db name ('pubmed', 'pmc', ...)
                     version='2.0',	# eutils output version (affects json?)
                     retmax=10000,	# max number of results to return
                                         # 10000 is XML output max for eutils
-                    URLReader=surl.ThrottledURLReader(),
+                    URLReader=defaultURLReader,
                     debug=False,
     ):
     """ Do esearch and get results as esummary or efetch.
@@ -264,10 +625,12 @@ def getPostResults(db,		# eutils db name ('pubmed', 'pmc', ...)
                     retmode='xml',	# eutils desired output format
                     rettype=None,	# eutils rettype option
                     version='2.0',	# eutils output version (affects json?)
-                    URLReader=surl.ThrottledURLReader(),
+                    URLReader=defaultURLReader,
                     debug=False,
     ):
     """ do a eutils.post and return eutils.efetch for the results
+        Note: eutils only return up to 10000 (500 for json) results, for
+            more IDs than that, see getPostResultsBatches()
     """
     webenvURLParams = doPost(db, ids, URLReader=URLReader, debug=debug)
 
@@ -279,6 +642,149 @@ def getPostResults(db,		# eutils db name ('pubmed', 'pmc', ...)
 
 # -------------------------
 
+def getPostResultsBatches(db,	# eutils db name ('pubmed', 'pmc', ...)
+                    ids,	# list (or iterable) of IDs to get results for
+                    op='summary',	# 'summary' or 'fetch' output
+                    retmode='xml',	# eutils desired output format
+                    rettype=None,	# eutils rettype option
+                    version='2.0',	# eutils output version (affects json?)
+                    batchSize=POST_BATCH_SIZE,	# max num of IDs per epost
+                                # (reduced to the eutils max results for
+                                #   retmode: 10000, or 500 for json.
+                                #   None or 0 means that max)
+                    URLReader=defaultURLReader,
+                    debug=False,
+    ):
+    """ Generator: do a eutils.post per batch of IDs (see doPostBatches())
+            and get the esummary or efetch results for each batch.
+        Yields (batch IDs (list of bytes), results (string)) for each batch
+            as it arrives.
+    """
+    maxBatch = 500 if retmode == 'json' else 10000	# eutils maxes
+    if batchSize == None or batchSize == 0: batchSize = maxBatch
+    batchSize = min(batchSize, maxBatch)
+
+    for batch, webenvURLParams in doPostBatches(db, ids, batchSize=batchSize,
+                                        URLReader=URLReader, debug=debug):
+        output = getResults(db, webenvURLParams, op=op, retmode=retmode,
+                        rettype=rettype, version=version, retmax=len(batch),
+                        URLReader=URLReader, debug=debug)
+        yield batch, output
+# -------------------------
+
+# -------------------------
+# asyncio versions of the functions above.
+# Same params and results, but use a simpleURLLib.AsyncURLReader, e.g.,
+#     URLReader = surl.AsyncURLReader(seconds=0.1)
+#     results = await asyncio.gather(
+#         getSearchResultsAsync('pubmed', query1, URLReader=URLReader),
+#         getSearchResultsAsync('pubmed', query2, URLReader=URLReader), )
+# All requests thru one AsyncURLReader share its rate limit and connections
+# -------------------------
+
+async def doSearchAsync(db,		# see doSearch()
+            queryString,
+            URLReader=defaultAsyncURLReader,
+            debug=False,
+    ):
+    """ async doSearch(): Return count and webenv/query_key (as URL params)
+    """
+    url = buildSearchURL(db, queryString)
+    if debug: sys.stderr.write( "Esearch URL:\n%s\n" % url)
+
+    outputX = await URLReader.readURL(url)
+    if debug: sys.stderr.write( "Output from Esearch:\n%s\n" % outputX)
+
+    count, webenv, query_key = getHeaderWebenv(outputX, op='esearch',
+                                                                count=True)
+    return count, codeWebenvURLParams(webenv, query_key)
+# -------------------------
+
+async def doPostAsync(db,		# see doPost()
+            ids,
+            URLReader=defaultAsyncURLReader,
+            debug=False,
+            webenvURLParams=None,
+    ):
+    """ async doPost(): Return webenv/query_key as eutils URL params
+    """
+    params = buildPostParams(db, ids, webenvURLParams=webenvURLParams)
+    url = EPOST_BASE
+    if debug:
+        sys.stderr.write( "Post URL:\n%s\n" % url[:200] )
+        sys.stderr.write( "Post Params: \n'%s'\n" % params[:200])
+
+    outputX = await URLReader.readURL(url, params=params, GET=False)
+    if debug: sys.stderr.write( "Output from Epost:\n%s\n" % outputX[:100])
+
+    webenv, query_key = getHeaderWebenv(outputX, op='epost')
+    return codeWebenvURLParams(webenv, query_key)
+# -------------------------
+
+async def getResultsAsync(db,		# see getResults()
+                webenvURLParams,
+                op='summary',
+                retmode='xml',
+                rettype=None,
+                version='2.0',
+                retmax=None,
+                URLReader=defaultAsyncURLReader,
+                debug=False,
+                retstart=0,
+    ):
+    """ async getResults(): Return esummary or efetch results (string)
+    """
+    url = buildResultsURL(db, webenvURLParams, op=op, retmode=retmode,
+                    rettype=rettype, version=version, retmax=retmax,
+                    retstart=retstart)
+    if debug: sys.stderr.write( "Summary/Fetch URL:\n%s\n" % url )
+
+    return await URLReader.readURL(url)
+# -------------------------
+
+async def getSearchResultsAsync(db,	# see getSearchResults()
+                    queryString,
+                    op='summary',
+                    retmode='xml',
+                    rettype=None,
+                    version='2.0',
+                    retmax=10000,
+                    URLReader=defaultAsyncURLReader,
+                    debug=False,
+    ):
+    """ async getSearchResults():
+        Return count of results, results (string), webenv/query_key as
+            eutils URL params
+    """
+    count, webenvURLParams = await doSearchAsync(db, queryString,
+                                URLReader=URLReader, debug=debug)
+
+    output = await getResultsAsync(db, webenvURLParams, op=op,
+                    retmode=retmode, rettype=rettype, version=version,
+                    retmax=retmax, URLReader=URLReader, debug=debug)
+    return count, output, webenvURLParams
+# -------------------------
+
+async def getPostResultsAsync(db,	# see getPostResults()
+                    ids,
+                    op='summary',
+                    retmode='xml',
+                    rettype=None,
+                    version='2.0',
+                    URLReader=defaultAsyncURLReader,
+                    debug=False,
+    ):
+    """ async getPostResults(): Return results (string), webenv/query_key
+    """
+    webenvURLParams = await doPostAsync(db, ids, URLReader=URLReader,
+                                                                debug=debug)
+
+    output = await getResultsAsync(db, webenvURLParams, op=op,
+                    retmode=retmode, rettype=rettype, version=version,
+                    URLReader=URLReader, debug=debug)
+    return output, webenvURLParams
+# -------------------------
+
 if __name__ == "__main__":      # test code
     URLReader = surl.ThrottledURLReader()
     query = 'Aging+Cell[TA]+AND+(2017/01/01:2017/02/01[PPDAT]+AND+foxo[TITLE})'
@@ -327,6 +833,15 @@ if __name__ == "__main__":      # test code
         print("output: \n%s" % output[:500])
         print()
 
+    if True:    # paging tests
+        print('-' * 30 + " ResultsBatches pubmed summary json, batches of 2")
+        count, webenv = doSearch('pubmed', query, URLReader=URLReader)
+        for retstart, output in getResultsBatches('pubmed', webenv, count,
+                op='summary', retmode='json', batchSize=2,
+                URLReader=URLReader, debug=False):
+            print("retstart: %d output: \n%s" % (retstart, output[:200]))
+        print()
+
     if True:    # post tests
         ids = [28440906, 28256074, ]
         ids = ['28440906', '28256074', ]
@@ -3,24 +3,46 @@
 # Name: httpReader.py
 # Purpose: provides an easy mechanism for retrieving HTML pages over the net,
 #       including performing queries against CGI scripts.  Includes mechanisms
-#       for timing-out slow responses.
+#       for timing-out slow responses.  The time-outs are socket-level
+#       deadlines (not SIGALRM), so readers can be used from any thread.
+#       Supports http and https URLs, follows redirects, and reuses open
+#       connections to a server (per thread) across httpReader objects.
 # Notes: This module provides two publicly available mechanisms for reading
 #       pages via HTTP.  For most cases, you should be able to use the
 #       getURL() function -- this is a wrapper over the more flexible
 #       httpReader class.  For some cases, you may want to use the class
 #       directly.  This is okay, too, though a bit more complicated to use.
+#       For large pages, iterLines() yields the lines of a page as they
+#       arrive rather than collecting the whole page first.
 
 import http.client          # standard Python libraries
+import sys
 import urllib.request, urllib.parse, urllib.error
 import re
 import socket
-
-import AlarmClock       # MGI libraries
+import time
+import zlib
+import threading
+import concurrent.futures
+import ssl
+import errno
+import codecs
 
 ###--- Global Variables ---###
 
 error = 'httpReader.error'      # exception to be raised by this module
 DEFAULT_TIMEOUT = 120           # two minutes is the default for timing out
+DEFAULT_ENCODING = 'utf-8'      # for decoding pages into strings
+ACCEPT_ENCODING = 'gzip, deflate'       # compressed pages we can decode
+READ_CHUNK_SIZE = 64 * 1024     # bytes to read from the connection at a time
+DEFAULT_WORKERS = 8             # default number of pages to get at once
+MAX_REDIRECTS = 5               # max number of redirects to follow
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+IDLE_TIMEOUT = 30               # seconds an unused connection is kept open
+SCHEMES = ('http', 'https')     # URL schemes we can get pages for
+
+# errors (besides ConnectionError) meaning we could not reach the server
+CONNECT_ERRNOS = (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.EADDRNOTAVAIL)
 
 # locate server and request in URL
 server_re = re.compile ('[a-zA-Z]+://([^/]+)(.*)')  
@@ -56,7 +78,323 @@ def getURL (url,                        # string; URL from which to get a page
         r = httpReader (url, parms, timeout)
         return r.getPage()
 
-###--- Public Class ---###
+def iterLines (url,                     # string; URL from which to get a page
+        parms = {},                     # dictionary; see getURL()
+        timeout = DEFAULT_TIMEOUT,      # integer; see getURL()
+        encoding = DEFAULT_ENCODING     # string; character encoding of the
+                                        #       page
+        ):
+        # Purpose: generator; connect to the given 'url', sending any
+        #       specified 'parms' along, and yield the lines of the page as
+        #       they are read
+        # Returns: yields the same strings as are in the list returned by
+        #       getURL(), one at a time
+        # Assumes: nothing
+        # Effects: makes an HTTP connection and reads from it
+        # Throws: propagates 'error' if the server name cannot be found
+        #       when parsing the 'url'; IOError with the same error string
+        #       getURL() would return if the page cannot be retrieved
+        # Example:
+        #       for line in iterLines ('http://kelso/data/big_file.txt'):
+        #               ...
+
+        r = httpReader (url, parms, timeout, encoding)
+        return r.iterLines()
+
+def getURLs (urls,                      # list of URLs to get pages from; each
+                                        #       is a string, or a tuple of
+                                        #       (string URL, parms dictionary)
+        timeout = DEFAULT_TIMEOUT,      # integer; how many seconds to wait
+                                        #       before giving up on each URL
+        maxWorkers = DEFAULT_WORKERS    # integer; max number of URLs to be
+                                        #       retrieving at once
+        ):
+        # Purpose: retrieve the pages for many 'urls' concurrently
+        # Returns: list with one (page, error) tuple for each of the 'urls',
+        #       in the same order; each is as returned by getURL()
+        # Assumes: nothing
+        # Effects: makes HTTP connections and reads from them
+        # Throws: nothing
+        # Notes: Each worker thread keeps its connections open and reuses
+        #       them for later URLs on the same server.
+        # Example:
+        #       results = getURLs ([ 'http://kelso/page1',
+        #               ('http://kelso/searches/allele_report',
+        #                       { '_Marker_key' : '3' }) ])
+        #       for page, error in results: ...
+
+        results = [ None ] * len(urls)
+        for i, page, error in iterURLs (urls, timeout, maxWorkers):
+                results[i] = (page, error)
+        return results
+
+def iterURLs (urls,                     # list of URLs; see getURLs()
+        timeout = DEFAULT_TIMEOUT,      # integer; see getURLs()
+        maxWorkers = DEFAULT_WORKERS    # integer; see getURLs()
+        ):
+        # Purpose: generator; retrieve the pages for many 'urls'
+        #       concurrently, yielding each page as soon as it is retrieved
+        # Returns: yields (index, page, error) for each of the 'urls', in the
+        #       order they complete, where 'index' is the position of the URL
+        #       in 'urls' and (page, error) is as returned by getURL()
+        # Assumes: nothing
+        # Effects: makes HTTP connections and reads from them
+        # Throws: nothing
+        # Notes: see getURLs()
+
+        local = threading.local()       # each worker's ConnectionCache
+        caches = []
+        lock = threading.Lock()
+
+        def getOne (item):
+                if type(item) == type(()):
+                        url, parms = item
+                else:
+                        url, parms = item, {}
+                if not hasattr(local, 'connections'):
+                        local.connections = ConnectionCache()
+                        with lock:
+                                caches.append (local.connections)
+                try:
+                        r = httpReader (url, parms, timeout)
+                except:
+                        return None, 'Cannot find server and request in %s' % url
+                r.setConnectionCache (local.connections)
+                return r.getPage()
+
+        pool = concurrent.futures.ThreadPoolExecutor (max_workers = maxWorkers)
+        try:
+                futures = {}
+                for i in range(len(urls)):
+                        futures[pool.submit (getOne, urls[i])] = i
+                for future in concurrent.futures.as_completed (futures):
+                        page, error = future.result()
+                        yield futures[future], page, error
+        finally:
+                pool.shutdown (wait = True, cancel_futures = True)
+                for connections in caches:
+                        connections.closeAll()
+
+###--- Private Functions ---###
+
+threadData = threading.local()  # per-thread data, see getConnectionCache()
+
+def getConnectionCache ():
+        # Purpose: get the ConnectionCache for the current thread, which is
+        #       shared by all httpReader objects used in this thread (unless
+        #       they are given their own via setConnectionCache())
+        # Returns: ConnectionCache
+        # Assumes: nothing
+        # Effects: creates the ConnectionCache on first use in each thread
+        # Throws: nothing
+
+        if not hasattr(threadData, 'connections'):
+                threadData.connections = ConnectionCache()
+        return threadData.connections
+
+def splitURL (url               # string; absolute URL
+        ):
+        # Purpose: split 'url' into its scheme, server, and request path
+        # Returns: tuple (scheme, server, request) of strings, or None if
+        #       we cannot find the server and request in 'url'
+        # Assumes: nothing
+        # Effects: uses 'server_re', so its properties will be changed
+        # Throws: nothing
+
+        match = server_re.match (url)
+        if not match:
+                return None
+        scheme = url.split(':')[0].lower()
+        return scheme, match.group(1), match.group(2) or '/'
+
+def setDeadline (sock,          # socket.socket; the connection's socket
+        deadline                # float; time.monotonic() value by which
+                                #       we must be done
+        ):
+        # Purpose: set the timeout on 'sock' so that its next blocking
+        #       operation gives up at the 'deadline'
+        # Returns: nothing
+        # Assumes: nothing
+        # Effects: changes the timeout of 'sock'
+        # Throws: socket.timeout if the 'deadline' has already passed
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+                raise socket.timeout('timed out')
+        if sock:
+                try:
+                        sock.settimeout (remaining)
+                except OSError:         # already closed by the connection;
+                        pass            # its previous timeout still applies
+        return
+
+def iterBody (rs,               # http.client.HTTPResponse
+        sock = None,            # socket.socket; the connection's socket
+        deadline = None         # float; time.monotonic() value by which
+                                #       we must be done reading, or None
+        ):
+        # Purpose: generator; read the body of 'rs' in chunks, decompressing
+        #       them as we go if the server sent it gzip or deflate compressed
+        # Returns: yields bytes; successive pieces of the (decompressed) body
+        # Assumes: we sent an Accept-Encoding header of ACCEPT_ENCODING
+        # Effects: reads from 'rs', and closes it once it is all read
+        # Throws: zlib.error if the body cannot be decompressed, IOError
+        #       for an unknown Content-Encoding, socket.timeout if the
+        #       'deadline' (or, if None, the socket's timeout) passes before
+        #       we are done
+
+        encoding = (rs.getheader('Content-Encoding') or 'identity').lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+                # 32+ means detect a gzip or zlib header
+                decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        elif encoding == 'identity':
+                decoder = None
+        else:
+                raise IOError('Unsupported Content-Encoding: %s' % encoding)
+
+        def readChunk():
+                if deadline is not None:
+                        setDeadline (sock, deadline)
+                return rs.read1(READ_CHUNK_SIZE)
+
+        chunk = readChunk()
+        if decoder and chunk and encoding == 'deflate':
+                # some servers send raw deflate data, with no zlib header
+                try:
+                        first = decoder.decompress(chunk)
+                except zlib.error:
+                        decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                        first = decoder.decompress(chunk)
+                yield first
+                chunk = readChunk()
+        while chunk:
+                if decoder:
+                        chunk = decoder.decompress(chunk)
+                yield chunk
+                chunk = readChunk()
+        if decoder:
+                yield decoder.flush()
+        rs.close()              # done; lets the connection send another
+        return
+
+def readBody (rs,               # http.client.HTTPResponse
+        sock = None,            # socket.socket; the connection's socket
+        deadline = None         # float; time.monotonic() value by which
+                                #       we must be done reading, or None
+        ):
+        # Purpose: read the whole body of 'rs'; see iterBody()
+        # Returns: bytes; the (decompressed) body
+        # Assumes: see iterBody()
+        # Effects: see iterBody()
+        # Throws: see iterBody()
+
+        return b''.join(iterBody(rs, sock, deadline))
+
+def describeError (server       # string; server we were reading from
+        ):
+        # Purpose: get the error string for the exception currently being
+        #       handled, for a page which we were getting from 'server'
+        # Returns: string
+        # Assumes: called from within an 'except' clause
+        # Effects: nothing
+        # Throws: nothing
+
+        # Notes: In Python 3, socket.error and IOError are both OSError, so
+        #       we look for the more specific exceptions first.
+
+        exc = sys.exc_info()[1]
+        if isinstance(exc, socket.timeout):
+                return 'Connection timed out'
+        if isinstance(exc, (ConnectionError, socket.gaierror)) or \
+                        (isinstance(exc, OSError) and
+                        exc.errno in CONNECT_ERRNOS):
+                return 'Could not connect to %s' % server
+        if isinstance(exc, (OSError, http.client.HTTPException, zlib.error)):
+                return 'Problem reading from %s' % server
+        return 'Unexpected error'
+
+###--- Public Classes ---###
+
+class ConnectionCache:
+        # IS:   a set of open HTTP/HTTPS connections, at most one per server,
+        #       kept so they can be reused for later requests to the same
+        #       server
+        # HAS:  a mapping from (scheme, server) to an idle connection
+        # DOES: hands out connections and takes them back when done
+        # Notes: A ConnectionCache is for use by only one thread at a time;
+        #       HTTPConnections cannot be shared between threads.  Each
+        #       thread has a default one; see getConnectionCache().
+
+        def __init__ (self):
+                # Purpose: instantiates the object
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: nothing
+
+                # (scheme, server) -> (idle connection, time it went idle)
+                self.connections = {}
+                return
+
+        def getConnection (self,
+                scheme,                 # string; 'http' or 'https'
+                server,                 # string; server name (and port)
+                timeout                 # number; seconds for socket timeout
+                ):
+                # Purpose: get a connection to 'server', reusing an idle one
+                #       if we have one
+                # Returns: tuple (HTTPConnection or HTTPSConnection, boolean
+                #       reused)
+                # Assumes: 'scheme' is one of SCHEMES
+                # Effects: the connection is removed from the cache until it
+                #       is given back with release(); connections idle for
+                #       more than IDLE_TIMEOUT seconds are closed, not reused
+                # Throws: nothing
+
+                key = (scheme, server)
+                if key in self.connections:
+                        conn, since = self.connections[key]
+                        del self.connections[key]
+                        if time.monotonic() - since <= IDLE_TIMEOUT:
+                                conn.timeout = timeout
+                                return conn, True
+                        conn.close()
+                if scheme == 'https':
+                        return http.client.HTTPSConnection (server,
+                                timeout = timeout,
+                                context = ssl.create_default_context()), False
+                return http.client.HTTPConnection (server,
+                        timeout = timeout), False
+
+        def release (self,
+                scheme,                 # string; 'http' or 'https'
+                server,                 # string; server name (and port)
+                conn                    # HTTPConnection; with its response
+                                        #       fully read
+                ):
+                # Purpose: give back 'conn' so it can be reused
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: closes any other idle connection to 'server'
+                # Throws: nothing
+
+                key = (scheme, server)
+                if key in self.connections:
+                        self.connections[key][0].close()
+                self.connections[key] = (conn, time.monotonic())
+                return
+
+        def closeAll (self):
+                # Purpose: close all idle connections
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: closes connections
+                # Throws: nothing
+
+                for conn, since in list(self.connections.values()):
+                        conn.close()
+                self.connections = {}
+                return
 
 class httpReader:
         # IS:   an object entrusted with reading HTML pages across HTTP
@@ -89,8 +427,10 @@ class httpReader:
                 baseURL,                # string; URL from which to get a page
                 parms = {},             # dictionary; string name:value pairs
                                         #       to pass as GET parameters
-                timeout=DEFAULT_TIMEOUT # integer; how many seconds to wait
+                timeout=DEFAULT_TIMEOUT,# integer; how many seconds to wait
                                         #       before giving up on the URL
+                encoding=DEFAULT_ENCODING # string; character encoding of
+                                        #       pages, for decoding them
                 ):
                 # Purpose: instantiates the object
                 # Returns: nothing
@@ -104,8 +444,13 @@ class httpReader:
                 self.baseURL = ''
                 self.request = ''
                 self.server = ''
+                self.scheme = 'http'
                 self.code = None
+                self.headers = {}
+                self.responseHeaders = None
+                self.connections = None
                 self.timeout = timeout          # handle the parameters
+                self.encoding = encoding
                 self.setBaseURL (baseURL)
                 self.setParms (parms)
                 return
@@ -120,13 +465,11 @@ class httpReader:
                 # Effects: uses 'server_re', so its properties will be changed
                 # Throws: 'error' if we cannot find the server name within
                 #       the 'baseURL'
-                global server_re
 
-                match = server_re.match (baseURL)
-                if not match:
+                parts = splitURL (baseURL)
+                if not parts:
                         raise error('Cannot find server and request in the given URL')
-                self.server = match.group(1)
-                self.request = match.group(2)
+                self.scheme, self.server, self.request = parts
                 self.baseURL = baseURL
                 return
 
@@ -173,6 +516,80 @@ class httpReader:
                 self.timeout = timeout
                 return
 
+        def setEncoding (self,
+                encoding=DEFAULT_ENCODING # string; character encoding of
+                                        #       pages, for decoding them
+                ):
+                # Purpose: set the character encoding used to decode pages
+                #       into strings; undecodable bytes are replaced
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: LookupError if 'encoding' is not known
+
+                codecs.lookup (encoding)
+                self.encoding = encoding
+                return
+
+        def setHeader (self,
+                name,           # string; name of the HTTP request header
+                value           # string; value of the header, or None to
+                                #       stop sending it
+                ):
+                # Purpose: set an extra HTTP header to send with each request
+                #       (eg- 'If-None-Match' for a conditional GET)
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: nothing
+
+                if value is None:
+                        if name in self.headers:
+                                del self.headers[name]
+                else:
+                        self.headers[name] = value
+                return
+
+        def setConnectionCache (self,
+                connections             # ConnectionCache; or None to use
+                                        #       the current thread's default
+                ):
+                # Purpose: have 'self' get (and give back) its connections
+                #       from 'connections', so they can be reused
+                # Returns: nothing
+                # Assumes: 'connections' is only used by the current thread
+                # Effects: nothing
+                # Throws: nothing
+
+                self.connections = connections
+                return
+
+        def getCode (self):
+                # Purpose: accessor -- retrieve the HTTP status code of the
+                #       last page retrieved (after following any redirects)
+                # Returns: integer, or None if no response was received
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: nothing
+
+                return self.code
+
+        def getResponseHeader (self,
+                name            # string; name of the HTTP response header
+                ):
+                # Purpose: accessor -- retrieve the value of the header with
+                #       the given 'name' from the response for the last page
+                #       retrieved (after following any redirects)
+                # Returns: string, or None if there was no such header (or
+                #       no response)
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: nothing
+
+                if self.responseHeaders is None:
+                        return None
+                return self.responseHeaders.get(name)
+
         def getServer (self):
                 # Purpose: accessor -- retrieve the server name to which the
                 #       httpReader expects to connect
@@ -230,6 +647,16 @@ class httpReader:
 
                 return self.timeout
 
+        def getEncoding (self):
+                # Purpose: accessor -- retrieve the character encoding used
+                #       to decode pages
+                # Returns: string
+                # Assumes: nothing
+                # Effects: nothing
+                # Throws: nothing
+
+                return self.encoding
+
         def getPage (self):
                 # Purpose: use the current settings (baseURL, timeout, parms)
                 #       for this httpReader to retrieve the page they specify
@@ -242,52 +669,234 @@ class httpReader:
                 # Assumes: nothing
                 # Effects: opens an HTTP connection and reads from it
                 # Throws: nothing
-
-                # build the string send as the page request, including any
-                # specified GET parameters:
-
-                request = self.baseURL
-                code = None
-                if self.parms:
-                        request = request + '?'
-                        for name in list(self.parms.keys()):
-                                request = request + '%s=%s' % (
-                                        urllib.parse.quote(name),
-                                        urllib.parse.quote(self.parms[name]))
+                # Notes: The timeout is a deadline for the whole retrieval
+                #       (connecting, sending, reading, and following up to
+                #       MAX_REDIRECTS redirects), enforced by socket
+                #       timeouts, so this is safe to call from any thread.
+
+                connections = self.connections or getConnectionCache()
+                deadline = time.monotonic() + self.getTimeout()
+                page = None
+                server = self.server
                 try:
-                        AlarmClock.set (self.getTimeout())      # set timeout
-
-                        # open the connection and send the request
-
-                        conn = http.client.HTTPConnection (self.server)
-                        conn.request ("GET", self.request)
-
-                        # get the reply and read it into a list of strings
-                        rs = conn.getresponse()
-                        page = rs.read().split("\n")
-                        error = None
+                        # open the connection, send the request, and follow
+                        # any redirects
+
+                        conn, sock, rs, scheme, server, error = \
+                                self.openPage (connections, deadline)
+
+                        # get the reply (decompressed if need be) and read
+                        # it into a list of strings
+
+                        if not error:
+                                try:
+                                        body = readBody(rs, sock, deadline)
+                                except:
+                                        conn.close()
+                                        raise
+                                self.releaseConnection (connections, scheme,
+                                        server, conn, rs)
+                                page = body.decode(self.encoding,
+                                        'replace').split("\n")
+                except:
+                        page = None
+                        error = describeError (server)
 
-                except AlarmClock.timeUp:       # the connection timed out,
-                        page = None             # so return None
-                        error = 'Connection timed out'
+                return page, error
 
-                except socket.error:
-                        page = None
-                        error = 'Could not connect to %s' % self.server
+        def iterLines (self):
+                # Purpose: generator; use the current settings (baseURL,
+                #       timeout, parms, encoding) for this httpReader to
+                #       retrieve the page they specify, yielding its lines
+                #       as they arrive rather than all at once
+                # Returns: yields the same strings as are in the list
+                #       returned by getPage(), one at a time
+                # Assumes: nothing
+                # Effects: opens an HTTP connection and reads from it
+                # Throws: IOError, with the error string getPage() would
+                #       return, if the page cannot be retrieved
+                # Notes: The timeout is a deadline for getting the start of
+                #       the page; after that, it limits how long we wait
+                #       for each further piece of the page, so a large page
+                #       can take as long as it needs.  If the caller stops
+                #       early, the connection is closed, not reused.
+
+                connections = self.connections or getConnectionCache()
+                deadline = time.monotonic() + self.getTimeout()
+                server = self.server
+                try:
+                        conn, sock, rs, scheme, server, error = \
+                                self.openPage (connections, deadline)
+                except Exception:
+                        raise IOError(describeError (server))
+                if error:
+                        raise IOError(error)
+
+                decoder = codecs.getincrementaldecoder (self.encoding) (
+                        'replace')
+                done = False
+                try:
+                        if sock:
+                                sock.settimeout (self.getTimeout())
+                        pending = ''
+                        for chunk in iterBody (rs, sock):
+                                lines = (pending + decoder.decode (chunk)
+                                        ).split("\n")
+                                pending = lines.pop()
+                                for line in lines:
+                                        yield line
+                        done = True
+                except Exception:
+                        raise IOError(describeError (server))
+                finally:
+                        if done:
+                                self.releaseConnection (connections, scheme,
+                                        server, conn, rs)
+                        else:
+                                conn.close()
+                yield pending + decoder.decode (b'', True)
+                return
 
-                except IOError:
-                        page = None
-                        error = 'Problem reading from %s' % self.server
+        def openPage (self,
+                connections,            # ConnectionCache; to get the
+                                        #       connection from
+                deadline                # float; time.monotonic() value by
+                                        #       which we must be done
+                ):
+                # Purpose: send the request for our page, following any
+                #       redirects, and get the final response's headers
+                # Returns: tuple (HTTPConnection, its socket, HTTPResponse,
+                #       scheme, server, error string) -- 'scheme' and
+                #       'server' are those we finally got the response from;
+                #       if 'error' is not None, the first three are None
+                # Assumes: nothing
+                # Effects: opens HTTP connections and reads from them; sets
+                #       self.code and self.responseHeaders from the response
+                # Throws: socket, http.client, and zlib exceptions if the
+                #       request fails; the connection is closed in these
+                #       cases
+                # Notes: PRIVATE.
 
-                except:
-                        page = None
-                        error = 'Unexpected error'
+                # build the string send as the page request, including any
+                # specified GET parameters:
 
-                AlarmClock.clear ()
+                request = self.request
+                if self.parms:
+                        if '?' in request:
+                                request = request + '&'
+                        else:
+                                request = request + '?'
+                        request = request + urllib.parse.urlencode(self.parms)
+
+                scheme = self.scheme
+                server = self.server
+                self.code = None
+                self.responseHeaders = None
+                for i in range(MAX_REDIRECTS + 1):
+                        if scheme not in SCHEMES:
+                                return None, None, None, scheme, server, \
+                                        'Unsupported URL scheme: %s' % scheme
+
+                        conn, sock, rs = self.sendRequest (connections,
+                                scheme, server, request, deadline)
+                        self.code = rs.status
+                        self.responseHeaders = rs.headers
+
+                        location = rs.getheader('Location')
+                        if self.code not in REDIRECT_CODES or not location:
+                                return conn, sock, rs, scheme, server, None
+
+                        # follow a redirect to wherever it points, after
+                        # reading the (usually empty) body of this response
+
+                        try:
+                                readBody(rs, sock, deadline)
+                        except:
+                                conn.close()
+                                raise
+                        self.releaseConnection (connections, scheme, server,
+                                conn, rs)
+
+                        parts = splitURL (urllib.parse.urljoin (
+                                '%s://%s%s' % (scheme, server, request),
+                                location))
+                        if not parts:
+                                return None, None, None, scheme, server, \
+                                        'Bad redirect from %s' % server
+                        scheme, server, request = parts
+
+                return None, None, None, scheme, server, \
+                        'Too many redirects from %s' % server
+
+        def releaseConnection (self,
+                connections,            # ConnectionCache; to give 'conn'
+                                        #       back to
+                scheme,                 # string; 'http' or 'https'
+                server,                 # string; server 'conn' is open to
+                conn,                   # HTTPConnection; from openPage()
+                rs                      # HTTPResponse; its response, which
+                                        #       has been fully read
+                ):
+                # Purpose: keep 'conn' for reuse if we can, else close it
+                # Returns: nothing
+                # Assumes: nothing
+                # Effects: see Purpose
+                # Throws: nothing
+                # Notes: PRIVATE.
 
-                self.code = code
+                if rs.will_close:
+                        conn.close()
+                else:
+                        connections.release (scheme, server, conn)
+                return
 
-                return page, error
+        def sendRequest (self,
+                connections,            # ConnectionCache; to get the
+                                        #       connection from
+                scheme,                 # string; 'http' or 'https'
+                server,                 # string; server name (and port)
+                request,                # string; path and query to GET
+                deadline                # float; time.monotonic() value by
+                                        #       which we must be done
+                ):
+                # Purpose: open (or reuse) a connection to 'server', send
+                #       the 'request', and get the response headers
+                # Returns: tuple (HTTPConnection, its socket, HTTPResponse)
+                # Assumes: 'scheme' is one of SCHEMES
+                # Effects: opens an HTTP connection and reads from it
+                # Throws: socket.timeout if the 'deadline' passes, other
+                #       socket and http.client exceptions if the request
+                #       fails; the connection is closed in these cases
+                # Notes: If a reused connection turns out to have been
+                #       closed by the server, we try once more with a new
+                #       connection. PRIVATE.
+
+                while True:
+                        # connecting may only take what is left of the
+                        # time before the 'deadline'
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                                raise socket.timeout('timed out')
+                        conn, reused = connections.getConnection (scheme,
+                                server, remaining)
+                        try:
+                                if conn.sock is None:
+                                        conn.connect()
+                                sock = conn.sock
+                                setDeadline (sock, deadline)
+                                headers = self.headers.copy()
+                                headers['Accept-Encoding'] = ACCEPT_ENCODING
+                                conn.request ("GET", request, headers = headers)
+                                setDeadline (sock, deadline)
+                                return conn, sock, conn.getresponse()
+                        except (http.client.RemoteDisconnected,
+                                        ConnectionResetError, BrokenPipeError):
+                                conn.close()
+                                if not reused:
+                                        raise
+                        except:
+                                conn.close()
+                                raise
 
 ###--- Self-Testing Code ---###
 
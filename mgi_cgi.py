@@ -17,22 +17,427 @@
 #
 # See the web interface CGI scripts for examples.  You will probably want to
 # create DEFAULT_FIELDS and DEFAULT_TYPES dictionaries as is done there.
+#
+# The DEFAULT_FIELDS passed in are treated as a template which is never
+# changed: rather than deep-copying it, each FieldStorage gets its own
+# shallow copy of each field's entry (and of any list value), so changes to
+# one FieldStorage's fields never reach the template or other FieldStorages.
+#
+# For speed, build a FormSchema from DEFAULT_FIELDS and DEFAULT_TYPES once,
+# when the CGI script is loaded, and pass it to each FieldStorage:
+#
+#     SCHEMA = mgi_cgi.FormSchema(DEFAULT_FIELDS, DEFAULT_TYPES)
+#     ...
+#     fields = mgi_cgi.FieldStorage(schema = SCHEMA)
+#
+# This also catches mistakes in DEFAULT_FIELDS and DEFAULT_TYPES when the
+# script starts, rather than when a form using them is submitted.
+#
+# The values of int_list and string_list fields are split up as they are
+# read (see iterListTokens()), and a FormSchema can be given options to trim
+# and de-duplicate them, cap how many are allowed, and spill very long lists
+# to a temp file:
+#
+#     SCHEMA = mgi_cgi.FormSchema(DEFAULT_FIELDS, DEFAULT_TYPES,
+#         trim = True, dedup = True, maxTokens = 100000, spill = 10000)
+#
+# With 'spill', close the FieldStorage when done with it (or use it in a
+# 'with' statement), to remove its temp files:
+#
+#     with mgi_cgi.FieldStorage(schema = SCHEMA) as fields:
+#         ...
+#
+# By default, FieldStorage reads the submission from the CGI environment
+# (os.environ and stdin).  To use it from a persistent WSGI worker instead,
+# pass the WSGI 'environ' (the body is read from its 'wsgi.input', or from a
+# given 'stream'), or pass a 'form' mapping of field names to values that
+# has already been parsed:
+#
+#     fields = mgi_cgi.FieldStorage(schema = SCHEMA, environ = environ)
  
 # Imports
 # =======
  
-import cgi
+import os
+import io
 import sys
 import urllib.request, urllib.parse, urllib.error
-import string
 import copy
-from types import *
+import functools
+import tempfile
+import json
+import sqlite3
+import email.parser
+import email.policy
 
 
 # Global Constants
 # ================
 
-error = 'FieldStorageError'
+class FieldStorageError(Exception):
+    # exception raised for problems with form content or a FormSchema
+    pass
+
+error = FieldStorageError
+
+# separates a field type (or 'op' or 'not') from a field name in a form key
+DELIM = ':'
+
+# Converters
+# ==========
+#
+# Each takes a form item (a field, or list of fields for a multi-valued key)
+# and the name of the field it is for, and returns the value to use.  The
+# list converters also take the options described in listTokens().
+
+def convertString(item, fieldName):
+    return item.value
+
+def convertInt(item, fieldName):
+    return int(item.value)
+
+def convertFloat(item, fieldName):
+    try:
+        return float(item.value)
+    except:
+        raise error('Unable to convert the ' \
+            + 'value "' + str(item.value) \
+            + '" to a number for field "' \
+            + fieldName + '".')
+
+def convertIntList(item, fieldName, **options):
+    if isinstance(item, list):
+        tokens = (miniItem.value for miniItem in item)
+    elif isinstance(item.value, str):
+        tokens = iterSplit(item.value)
+    else: # It's an instance
+        return item.value
+    return listTokens(tokens, fieldName, convert = int, **options)
+
+def convertStringList(item, fieldName, **options):
+    if isinstance(item, list):
+        tokens = (miniItem.value for miniItem in item)
+    elif isinstance(item.value, str):
+        tokens = iterListTokens(item.value)
+    else: # It's an instance
+        return item.value
+    return listTokens(tokens, fieldName, **options)
+
+def convertOptionList(item, fieldName):
+    if isinstance(item, list):
+        return [ miniItem.value for miniItem in item ]
+    else: # It's an instance
+        return [item.value]
+
+# List Tokens
+# ===========
+
+def iterSplit(text, delim = ','):
+    # Purpose: generator; split 'text' on 'delim' like text.split(delim),
+    #   but without building the whole list at once
+    # Returns: yields each piece of 'text' in turn
+    # Assumes: nothing
+    # Effects: nothing
+    start = 0
+    pos = text.find(delim)
+    while pos != -1:
+        yield text[start:pos]
+        start = pos + len(delim)
+        pos = text.find(delim, start)
+    yield text[start:]
+
+def iterListTokens(text):
+    # Purpose: generator; split the submitted value 'text' of a string_list
+    #   field into its items, following the rules FieldStorage has always
+    #   used: a value in double quotes is one item (without the quotes), a
+    #   value ending in a comma is one item (without the comma), and
+    #   otherwise items are separated by commas, each of which may be
+    #   followed by one space
+    # Returns: yields each item (string) in turn
+    # Assumes: nothing
+    # Effects: nothing
+    # Notes: This works through 'text' as it goes, so a huge pasted list
+    #   of IDs is not copied or split into a list all at once.
+
+    # find the value without any surrounding white space
+    start = 0
+    end = len(text)
+    while start < end and text[start].isspace():
+        start = start + 1
+    while end > start and text[end - 1].isspace():
+        end = end - 1
+
+    #Double-Quoted strings should not be split
+    if end > start and text[start] == '"' and text[end - 1] == '"':
+        yield text[start + 1:end - 1]
+    elif end > start and text[end - 1] == ',': #strip any trailing comma
+        yield text[start:end - 1]
+    else:
+        first = True
+        for token in iterSplit(text):
+            if token[:1] == ' ' and not first:
+                token = token[1:]
+            first = False
+            yield token
+
+def listTokens(tokens, fieldName, convert = None, trim = False, dedup = False,
+        maxTokens = None, spill = None):
+    # Purpose: collect the 'tokens' for a list field into its value
+    # Returns: list of the tokens, or a TokenSpool if there are more than
+    #   'spill' of them
+    # Assumes: nothing
+    # Effects: may write to a temp file (see TokenSpool)
+    # Throws: 'error' if there are more than 'maxTokens' tokens (we stop
+    #   reading 'tokens' at that point); propagates exceptions from
+    #   'convert' (eg- ValueError)
+    # Notes: The options are:
+    #   convert -- function applied to each token (eg- int)
+    #   trim -- strip white space from each token, and skip empty ones
+    #   dedup -- skip any token already seen (after trimming and
+    #       converting), keeping the first; with 'spill', the tokens seen
+    #       are kept on disk too (see TokenSet)
+    #   maxTokens -- the most tokens allowed (after trimming and dedup)
+    #   spill -- if given, keep at most this many tokens in memory, and
+    #       put the rest in a temp file
+    if not (trim or dedup or maxTokens or spill):
+        if convert:
+            return list(map(convert, tokens))
+        return list(tokens)
+
+    if spill:
+        values = TokenSpool(spill)
+        seen = TokenSet(spill)
+    else:
+        values = []
+        seen = set()
+    try:
+        for token in tokens:
+            if trim:
+                token = token.strip()
+                if not token:
+                    continue
+            if convert:
+                token = convert(token)
+            if dedup:
+                if token in seen:
+                    continue
+                seen.add(token)
+            if maxTokens and len(values) >= maxTokens:
+                raise error('Too many values were given for field "%s"; '
+                    'the limit is %d.' % (fieldName, maxTokens))
+            values.append(token)
+    except:
+        if spill:
+            values.close()
+        raise
+    finally:
+        if spill:
+            seen.close()
+    return values
+
+# SQL Values
+# ==========
+
+# maps each operator which becomes a 'like' to the (prefix, suffix) wildcards
+# to put around its value(s)
+WILDCARDS = {
+    'begins'   : ('', '%'),
+    'ends'     : ('%', ''),
+    'contains' : ('%', '%'),
+    }
+
+# max number of values in one IN (...) list in SQL from sqlCondition(); longer
+# lists are split into several IN lists, OR-ed together
+MAX_IN_LIST = 1000
+
+def wrapValue(val, prefix, suffix):
+    # Purpose: put the 'prefix' and 'suffix' around 'val', or around each
+    #   string in 'val' if it is a list
+    # Returns: string or list; a new one, 'val' is not changed
+    # Assumes: nothing
+    # Effects: nothing
+    if isinstance(val, str):
+        return prefix + val + suffix
+    elif isinstance(val, list):
+        return [ prefix + v + suffix for v in val ]
+    elif isinstance(val, TokenSpool):
+        return val.map(lambda v: prefix + v + suffix)
+    return val
+
+def sqlCondition(column, op, val, placeholder = '%s', maxInList = MAX_IN_LIST):
+    # Purpose: build a parameterized SQL condition comparing 'column' to
+    #   'val' with 'op' (as for a field in FieldStorage.fields)
+    # Returns: tuple of (SQL string, list of parameters) -- the SQL has a
+    #   'placeholder' for each parameter, for the database module to fill in
+    # Assumes: 'column' is a trusted SQL expression, not user input
+    # Effects: nothing
+    # Throws: 'error' for a list 'val' with an operator other than '=',
+    #   '!=', 'like', or 'not like'
+    # Notes: A list 'val' with '=' or '!=' becomes [NOT] IN lists of at most
+    #   'maxInList' values each; with 'like' or 'not like' it becomes LIKE
+    #   conditions OR-ed (or, for 'not like', AND-ed) together.  This avoids
+    #   building huge SQL strings from the values of big batch queries.
+    if op in ('is', 'is not'):
+        return ('%s %s null' % (column, op), [])
+    if isinstance(val, TokenSpool):
+        val = list(val)
+    if not isinstance(val, list):
+        return ('%s %s %s' % (column, op, placeholder), [ val ])
+
+    if op in ('=', '!='):
+        if op == '=':
+            (inOp, joiner) = ('in', ' or ')
+        else:
+            (inOp, joiner) = ('not in', ' and ')
+        clauses = []
+        for i in range(0, len(val), maxInList):
+            count = len(val[i:i + maxInList])
+            clauses.append('%s %s (%s)' % (column, inOp,
+                ','.join([placeholder] * count)))
+    elif op in ('like', 'not like'):
+        if op == 'like':
+            joiner = ' or '
+        else:
+            joiner = ' and '
+        clauses = [ '%s %s %s' % (column, op, placeholder) ] * len(val)
+    else:
+        raise error('Cannot use operator "%s" with a list of values' % op)
+
+    if not clauses:         # empty list matches nothing (or everything)
+        if op in ('=', 'like'):
+            return ('1 = 0', [])
+        return ('1 = 1', [])
+    return ('(' + joiner.join(clauses) + ')', list(val))
+
+# Form Input
+# ==========
+
+def parseQueryString(qs, form):
+    # Purpose: add the fields from the urlencoded string 'qs' to 'form'
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: adds to 'form' (a ParsedForm)
+    # Notes: as with cgi.FieldStorage, fields with blank values are skipped
+    for (name, value) in urllib.parse.parse_qsl(qs):
+        form.add(FormItem(name, value))
+
+def parseMultipart(body, contentType, form):
+    # Purpose: add the fields from the multipart/form-data 'body' (bytes)
+    #   to 'form'
+    # Returns: nothing
+    # Assumes: 'contentType' is the request's Content-Type, with boundary
+    # Effects: adds to 'form' (a ParsedForm)
+    # Notes: uploaded files have their contents (bytes) as the value, with
+    #   the 'filename' and a 'file' to read them from; other fields have a
+    #   string value.
+    message = email.parser.BytesParser(policy = email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + contentType.encode('latin-1') + b'\r\n\r\n'
+        + body)
+    if not message.is_multipart():
+        raise error('Could not parse the multipart form submission')
+    for part in message.iter_parts():
+        name = part.get_param('name', header = 'content-disposition')
+        if name is None:
+            continue
+        data = part.get_payload(decode = True) or b''
+        filename = part.get_filename()
+        if filename is None:
+            value = data.decode(part.get_content_charset() or 'utf-8',
+                'replace')
+            form.add(FormItem(name, value))
+        else:
+            form.add(FormItem(name, data, filename))
+
+def readForm(environ, stream = None):
+    # Purpose: parse the form submission described by the CGI or WSGI
+    #   'environ', reading any body from 'stream' (or, if None, from
+    #   environ['wsgi.input'])
+    # Returns: ParsedForm
+    # Assumes: nothing
+    # Effects: reads the request body (CONTENT_LENGTH bytes) from 'stream'
+    # Throws: 'error' if the body cannot be parsed
+    # Notes: handles application/x-www-form-urlencoded and
+    #   multipart/form-data bodies; as with cgi.FieldStorage, any fields in
+    #   the QUERY_STRING are included too.
+    form = ParsedForm()
+    parseQueryString(environ.get('QUERY_STRING', ''), form)
+
+    if environ.get('REQUEST_METHOD', 'GET').upper() != 'POST':
+        return form
+
+    if stream is None:
+        stream = environ.get('wsgi.input')
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise error('Invalid CONTENT_LENGTH: %s' % environ['CONTENT_LENGTH'])
+    body = b''
+    if stream is not None and length > 0:
+        body = stream.read(length)
+
+    contentType = environ.get('CONTENT_TYPE', '')
+    mimeType = contentType.split(';')[0].strip().lower()
+    if mimeType == 'multipart/form-data':
+        parseMultipart(body, contentType, form)
+    elif mimeType in ('', 'application/x-www-form-urlencoded'):
+        # (decoded as cgi.FieldStorage does, so both paths agree)
+        parseQueryString(body.decode('utf-8', 'replace'), form)
+    return form
+
+def makeForm(mapping):
+    # Purpose: make a ParsedForm from an already-parsed 'mapping' of field
+    #   name to value (a string, or a list of strings for a multi-valued
+    #   field)
+    # Returns: ParsedForm
+    # Assumes: nothing
+    # Effects: nothing
+    form = ParsedForm()
+    for (name, value) in list(mapping.items()):
+        if not isinstance(value, (list, tuple)):
+            value = [ value ]
+        for v in value:
+            if hasattr(v, 'value'):     # already a form item
+                form.add(v)
+            else:
+                form.add(FormItem(name, v))
+    return form
+
+def readCgiForm():
+    # Purpose: parse the form submission for this CGI process, from
+    #   os.environ and stdin
+    # Returns: cgi.FieldStorage if the 'cgi' module is available, or a
+    #   ParsedForm if not
+    # Assumes: nothing
+    # Effects: reads stdin
+    try:
+        import cgi      # deprecated, and gone from newer Pythons
+    except ImportError:
+        return readForm(os.environ, sys.stdin.buffer)
+    return cgi.FieldStorage()
+
+# maps each field type which may be used in DEFAULT_TYPES (or as a prefix on
+# a form key) to its converter
+CONVERTERS = {
+    'string'      : convertString,
+    'int'         : convertInt,
+    'float'       : convertFloat,
+    'int_list'    : convertIntList,
+    'string_list' : convertStringList,
+    'option_list' : convertOptionList,
+    }
+
+def copyEntry(entry):
+    # Purpose: copy a field's { 'op' : ..., 'val' : ... } 'entry', including
+    #   its value if that is a list or dictionary
+    # Returns: dictionary; the new entry
+    # Assumes: other values (strings, numbers, None) are never changed in
+    #   place, so they can be shared
+    # Effects: nothing
+    entry = dict(entry)
+    val = entry.get('val')
+    if isinstance(val, (list, dict)):
+        entry['val'] = copy.copy(val)
+    return entry
 
 def processDisplayFields(displayFields,nots) :
     # Purpose: Convert displayFields into a slightly more user
@@ -41,7 +446,7 @@ def processDisplayFields(displayFields,nots) :
     # Assumes: nothing
     # Effects: nothing
     for key in list(displayFields.keys()):
-        if displayFields[key]['val'] is None:
+        if displayFields[key].get('val') is None:
             if displayFields[key]['op'] == 'is null':
                 displayFields[key]['val'] = 'null'
                 displayFields[key]['op'] = 'is'
@@ -64,6 +469,280 @@ def processDisplayFields(displayFields,nots) :
 # Classes
 # =======
 
+class FormItem:
+    # IS: one submitted value for a form field (like cgi.MiniFieldStorage)
+    # HAS: the field name and value; for an uploaded file, the filename
+    #   and a file to read its contents from
+
+    def __init__(self, name, value, filename = None):
+        self.name = name
+        self.value = value
+        self.filename = filename
+        self.file = None
+        if filename is not None:
+            self.file = io.BytesIO(value)
+
+    def __repr__(self):
+        return 'FormItem(%r, %r)' % (self.name, self.value)
+
+
+class ParsedForm:
+    # IS: a form submission, parsed by mgi_cgi rather than cgi
+    # HAS: a mapping from each field name to its FormItem, or to a list of
+    #   FormItems if the field was submitted more than once
+    # DOES: provides the parts of the cgi.FieldStorage interface we use
+
+    def __init__(self):
+        self.items = {}
+
+    def __copy__(self):
+        form = ParsedForm()
+        form.items = dict(self.items)
+        return form
+
+    def add(self, item):
+        # Purpose: add the FormItem 'item' to the form
+        if item.name not in self.items:
+            self.items[item.name] = item
+        elif isinstance(self.items[item.name], list):
+            self.items[item.name].append(item)
+        else:
+            self.items[item.name] = [ self.items[item.name], item ]
+
+    def keys(self):
+        return list(self.items.keys())
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, key):
+        return self.items[key]
+
+    def getvalue(self, key, default = None):
+        if key not in self.items:
+            return default
+        item = self.items[key]
+        if isinstance(item, list):
+            return [ x.value for x in item ]
+        return item.value
+
+    def getfirst(self, key, default = None):
+        values = self.getlist(key)
+        if values:
+            return values[0]
+        return default
+
+    def getlist(self, key):
+        value = self.getvalue(key, [])
+        if isinstance(value, list):
+            return value
+        return [ value ]
+
+
+class TokenSpool:
+    # IS: a list of tokens (strings or ints) for a list field, which keeps
+    #   only so many in memory and puts the rest in a temp file
+    # HAS: the tokens, in the order they were added
+    # DOES: appends tokens, and iterates over them (more than once if
+    #   need be)
+
+    def __init__(self, inMemory):
+        # Purpose: make an empty spool which keeps at most 'inMemory'
+        #   tokens in memory
+        self.inMemory = inMemory
+        self.tokens = []        # the first 'inMemory' tokens
+        self.file = None        # temp file for the rest, one per line
+        self.count = 0
+
+    def append(self, token):
+        if len(self.tokens) < self.inMemory:
+            self.tokens.append(token)
+        else:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(mode = 'w+',
+                    encoding = 'utf-8')
+            # as JSON, each token is one line, and ints come back as ints
+            self.file.write(json.dumps(token) + '\n')
+        self.count = self.count + 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for token in self.tokens:
+            yield token
+        if self.file is not None:
+            self.file.flush()
+            self.file.seek(0)
+            for line in self.file:
+                yield json.loads(line)
+
+    def map(self, function):
+        # Purpose: get a new TokenSpool with 'function' applied to each
+        #   token in this one
+        spool = TokenSpool(self.inMemory)
+        for token in self:
+            spool.append(function(token))
+        return spool
+
+    def close(self):
+        # Purpose: remove the temp file, if any
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.count = len(self.tokens)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __repr__(self):
+        # show only the first few tokens, as the spool may be huge
+        shown = self.tokens[:10]
+        if self.count > len(shown):
+            return 'TokenSpool(%s ... %d tokens in all)' % (
+                repr(shown)[:-1], self.count)
+        return 'TokenSpool(%r)' % shown
+
+
+class TokenSet:
+    # IS: a set of tokens (strings or ints), as for 'dedup' in listTokens(),
+    #   which keeps only so many in memory and puts the rest in a temp
+    #   database
+    # HAS: the tokens added so far
+    # DOES: adds tokens, and checks whether a token has been added
+
+    def __init__(self, inMemory):
+        # Purpose: make an empty set which keeps at most 'inMemory' tokens
+        #   in memory
+        self.inMemory = inMemory
+        self.tokens = set()     # the first 'inMemory' tokens
+        self.db = None          # temp database for the rest
+
+    def key(self, token):
+        # as JSON, so 1 and '1' are still different tokens
+        return json.dumps(token)
+
+    def add(self, token):
+        if len(self.tokens) < self.inMemory:
+            self.tokens.add(token)
+            return
+        if self.db is None:
+            # an empty name gives a temp database on disk, removed on close
+            self.db = sqlite3.connect('')
+            self.db.execute('create table tokens (token text primary key)')
+        self.db.execute('insert or ignore into tokens values (?)',
+            (self.key(token),))
+
+    def __contains__(self, token):
+        if token in self.tokens:
+            return True
+        if self.db is None:
+            return False
+        return self.db.execute('select 1 from tokens where token = ?',
+            (self.key(token),)).fetchone() is not None
+
+    def close(self):
+        # Purpose: remove the temp database, if any
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class FormSchema:
+    # IS: the compiled form of a DEFAULT_FIELDS / DEFAULT_TYPES pair
+    # HAS: the default fields, and a mapping from each form key we can
+    #   expect ('name', 'op:name', 'not:name', 'int:name', ...) to what
+    #   to do with it
+    # DOES: checks the defaults and types for consistency, and looks up
+    #   form keys for FieldStorage
+
+    def __init__(self, defaultFields={}, fieldTypes={}, strict=True,
+            **listOptions):
+        # Purpose: compile the schema for 'defaultFields' (field name ->
+        #   { 'op' : ..., 'val' : ... }) and 'fieldTypes' (field name ->
+        #   field type, for keys submitted without a type prefix).  Any
+        #   'listOptions' (trim, dedup, maxTokens, spill; see listTokens())
+        #   are used for all int_list and string_list fields.
+        # Returns: nothing
+        # Assumes: 'defaultFields' is not modified afterwards
+        # Effects: nothing
+        # Throws: if 'strict', 'error' if a field default is missing its
+        #   'op' or 'val', or if 'fieldTypes' has an unknown type or a field
+        #   which is not in 'defaultFields'
+        # Notes: With 'strict' false (as for the schema FieldStorage makes
+        #   when it is not given one), these are not checked, and fields of
+        #   unknown types are ignored, as FieldStorage always did.
+
+        if strict:
+            self.check(defaultFields, fieldTypes)
+
+        self.defaultFields = defaultFields
+        self.fieldTypes = fieldTypes
+
+        # field type -> converter, with the 'listOptions' applied
+        self.converters = dict(CONVERTERS)
+        if listOptions:
+            for fieldType in ('int_list', 'string_list'):
+                self.converters[fieldType] = functools.partial(
+                    CONVERTERS[fieldType], **listOptions)
+
+        # form key -> (field type, field name, converter or None)
+        self.keys = {}
+        for fieldName in list(defaultFields.keys()):
+            self.keys['op' + DELIM + fieldName] = ('op', fieldName, None)
+            self.keys['not' + DELIM + fieldName] = ('not', fieldName, None)
+            for (fieldType, converter) in list(self.converters.items()):
+                self.keys[fieldType + DELIM + fieldName] = (fieldType,
+                    fieldName, converter)
+        for (fieldName, fieldType) in list(fieldTypes.items()):
+            if DELIM not in fieldName:
+                self.keys[fieldName] = (fieldType, fieldName,
+                    self.converters.get(fieldType))
+
+    def check(self, defaultFields, fieldTypes):
+        # Purpose: check 'defaultFields' and 'fieldTypes' for consistency
+        # Returns: nothing
+        # Assumes: nothing
+        # Effects: nothing
+        # Throws: 'error'; see __init__()
+
+        for (fieldName, default) in list(defaultFields.items()):
+            if 'op' not in default or 'val' not in default:
+                raise error('Default for field "%s" needs both an op and a val'
+                    % fieldName)
+        for (fieldName, fieldType) in list(fieldTypes.items()):
+            if fieldType not in CONVERTERS:
+                raise error('Unknown type "%s" for field "%s"' % (fieldType,
+                    fieldName))
+            if fieldName not in defaultFields:
+                raise error('Field "%s" has a type but no default' %
+                    fieldName)
+
+    def lookup(self, key):
+        # Purpose: find what to do with the form 'key'
+        # Returns: tuple of (field type, field name, converter), where the
+        #   converter is None for 'op' and 'not' keys (and unknown types,
+        #   which are ignored)
+        # Assumes: nothing
+        # Effects: nothing
+        # Throws: KeyError if 'key' has no type and none is in the schema
+
+        if key in self.keys:
+            return self.keys[key]
+
+        # not one we expected, so work it out as FieldStorage always has
+        if DELIM in key:
+            fieldType = key.split(DELIM)[0]
+            fieldName = key.split(DELIM)[1]
+            return (fieldType, fieldName, self.converters.get(fieldType))
+        raise KeyError(key)
+
 class Field:
 
     opList = {
@@ -91,15 +770,43 @@ class Field:
 
 
 class FieldStorage:
-    def __init__(self, originalFields={}, fieldTypes={}):
-        # Store a safe copy for posible later use
-        self.originalFields = copy.deepcopy(originalFields)
-        # Make sure we don't chnage the originals in case the caller uses them
-        fields = copy.deepcopy(originalFields)
-
-        delim = ':'
-        #get the arguments from standard in
-        form = cgi.FieldStorage()
+    def __init__(self, originalFields={}, fieldTypes={}, schema=None,
+            form=None, environ=None, stream=None):
+        # The 'schema' is a FormSchema; if it is not given, one is made from
+        # 'originalFields' and 'fieldTypes' (which are ignored otherwise),
+        # without FormSchema's strict checks.
+        # The submission is taken from 'form' (a mapping of already-parsed
+        # field values) if given, else from the WSGI 'environ' (with its
+        # body read from 'stream' or environ['wsgi.input']), else from the
+        # CGI environment.
+        if schema is None:
+            schema = FormSchema(originalFields, fieldTypes, strict=False)
+        originalFields = schema.defaultFields
+        self.schema = schema
+
+        # Keep the originals for posible later use.  They are a template
+        # which we never change, and nothing we give out shares any part of
+        # them (see copyEntry), so there is no need to copy them.
+        self.originalFields = originalFields
+
+        # new entries for the fields given values by the form, as an overlay
+        # on the 'originalFields' template
+        overlay = {}
+
+        def getEntry(fieldName):
+            # the overlay entry for 'fieldName', made from the template the
+            # first time it is needed
+            if fieldName not in overlay:
+                overlay[fieldName] = dict(originalFields[fieldName])
+            return overlay[fieldName]
+
+        #get the arguments
+        if form is not None:
+            form = makeForm(form)
+        elif environ is not None:
+            form = readForm(environ, stream)
+        else:
+            form = readCgiForm()
 
         # preserve the original submission from the form or URL
         self.cgiFieldStorage = form
@@ -118,142 +825,86 @@ class FieldStorage:
 
             # determine the type of the argument.  If none specified,
             # use the default
-            if string.find(key, delim) != -1:
-                fieldType = string.split(key, delim)[0]
-                fieldName = string.split(key, delim)[1]
-            elif key in fieldTypes:
-                fieldType = fieldTypes[key]
-                fieldName = key
-            else:
-                raise KeyError(key)
+            (fieldType, fieldName, converter) = schema.lookup(key)
 
             if fieldType == 'op':
-                fields[fieldName]['op'] = item.value
+                getEntry(fieldName)['op'] = item.value
             elif fieldType == 'not':
                 nots.append(fieldName)
-            elif fieldType == 'string':
-                fields[fieldName]['val'] = item.value
-            elif fieldType == 'int':
-                fields[fieldName]['val'] = \
-                    string.atoi(item.value)
-            elif fieldType == 'float':
-                try:
-                    fields[fieldName]['val'] = \
-                        string.atof(item.value)
-                except:
-                    raise error('Unable to convert the ' \
-                        + 'value "' + str(item.value) \
-                        + '" to a number for field "' \
-                        + fieldName + '".')
-            elif fieldType == 'int_list':
-                if type(item) is ListType:
-                    fields[fieldName]['val'] = []
-                    for miniItem in item:
-                        fields[fieldName]['val'].append(
-                            string.atoi(
-                                miniItem.value))
-                elif type(item.value) is StringType:
-                    fields[fieldName]['val'] = []
-                    for s in string.split(item.value, ','):
-                        fields[fieldName]['val'].append(
-                            string.atoi(s))
-                else: # It's an instance
-                    fields[fieldName]['val'] = \
-                        item.value
-            elif fieldType == 'string_list':
-                if type(item) is ListType:
-                    fields[fieldName]['val'] = []
-                    for miniItem in item:
-                        fields[fieldName]['val'].append(
-                            miniItem.value)
-                elif type(item.value) is StringType:
-                    tmpItem = item.value;
-                    tmpItem = tmpItem.strip()
-               
-                    #Double-Quoted strings should not be split
-                    if (tmpItem[:1] == "\"" and tmpItem[-1:] == "\""):
-                        tmpItem = tmpItem[1:-1]
-                        fields[fieldName]['val'] = [tmpItem]
-                    elif (tmpItem[-1:] == ","): #strip any trailing comma
-                        tmpItem = tmpItem[:-1]
-                        fields[fieldName]['val'] = [tmpItem]
-                    else:
-                        item.value = item.value.replace(', ', ',')
-                        fields[fieldName]['val'] = \
-                            string.split(item.value, ',')
-                else: # It's an instance
-                    fields[fieldName]['val'] = \
-                        item.value
-            elif fieldType == 'option_list':
-                if type(item) is ListType:
-                    fields[fieldName]['val'] = []
-                    for miniItem in item:
-                        fields[fieldName]['val'].append(
-                            miniItem.value)
-                else: # It's an instance
-                    fields[fieldName]['val'] = [item.value]
+            elif converter:
+                getEntry(fieldName)['val'] = converter(item, fieldName)
 
         # Now that the initial construction is taken care of, save the 
-        # operators and values before they are made into SQL.
-        displayFields = copy.deepcopy(fields)
-        # Modify the operators for display
-        self.displayFields = processDisplayFields(displayFields,nots)
+        # operators and values before they are made into SQL.  These
+        # entries may be the template's own, so they are only read; the
+        # display version is made from copies of them, and only if it is
+        # asked for (see displayFields).
+        self.parsedFields = dict(originalFields)
+        self.parsedFields.update(overlay)
+        self.nots = nots
+        self.cachedDisplayFields = None
+
+        # 'fields' gets its own copy of each entry, so the caller can change
+        # them freely; the 2nd pass replaces entries rather than changing
+        # them, so the display version is not affected either.
+        fields = {}
+        for key in list(self.parsedFields.keys()):
+            fields[key] = copyEntry(self.parsedFields[key])
       
         # 2nd pass - Modify values as necessary.  Delete field if None.
         for key in list(fields.keys()):
-            if fields[key]['val'] is None:
-                if fields[key]['op'] == 'is null':
-                    fields[key]['val'] = 'null'
-                    fields[key]['op'] = 'is'
-                elif fields[key]['op'] == 'is not null':
-                    fields[key]['val'] = 'null'
-                    fields[key]['op'] = 'is not'
+            # (a default with no op or val is treated as None)
+            op = fields[key].get('op')
+            val = fields[key].get('val')
+            if val is None:
+                if op == 'is null':
+                    fields[key] = { 'op' : 'is', 'val' : 'null' }
+                elif op == 'is not null':
+                    fields[key] = { 'op' : 'is not', 'val' : 'null' }
                 else:
                     del fields[key]
-            elif fields[key]['op'] == 'begins':
-                fields[key]['op'] = 'like'
-                if type(fields[key]['val']) is StringType:
-                    fields[key]['val'] = fields[key]['val']\
-                        + '%'
-                elif type(fields[key]['val']) is ListType:
-                    for i in range(len(fields[key]['val'])):
-                        fields[key]['val'][i] = \
-                            fields[key]['val'][i] \
-                            + '%'
-            elif fields[key]['op'] == 'ends':
-                fields[key]['op'] = 'like'
-                if type(fields[key]['val']) is StringType:
-                    fields[key]['val'] = '%' \
-                        + fields[key]['val']
-                elif type(fields[key]['val']) is ListType:
-                    for i in range(len(fields[key]['val'])):
-                        fields[key]['val'][i] = '%' \
-                            + fields[key]['val'][i]
-            elif fields[key]['op'] == 'contains':
-                fields[key]['op'] = 'like'
-                if type(fields[key]['val']) is StringType:
-                    fields[key]['val'] = '%' \
-                        + fields[key]['val'] \
-                        + '%'
-                elif type(fields[key]['val']) is ListType:
-                    for i in range(len(fields[key]['val'])):
-                        fields[key]['val'][i] = '%' \
-                            + fields[key]['val'][i]\
-                            + '%'
+            elif op in WILDCARDS:
+                (prefix, suffix) = WILDCARDS[op]
+                fields[key] = { 'op' : 'like',
+                    'val' : wrapValue(val, prefix, suffix) }
 
         # Modify operators if NOT has been checked.
         for key in nots:
             if key in fields:
-                if fields[key]['op'] == '=':
-                    fields[key]['op'] = '!='
-                elif fields[key]['op'] == 'is':
-                    fields[key]['op'] = 'is not'
+                op = fields[key]['op']
+                if op == '=':
+                    op = '!='
+                elif op == 'is':
+                    op = 'is not'
                 else: # The operator is 'like', 'begins', etc.
-                    fields[key]['op'] = 'not ' \
-                        + fields[key]['op']
+                    op = 'not ' + op
+                fields[key] = { 'op' : op, 'val' : fields[key]['val'] }
 
         self.fields = fields
 
+    @property
+    def displayFields(self):
+        # Purpose: get the operators and values as submitted (before they
+        #   were made into SQL), modified to be more user readable
+        # Returns: dictionary; field name -> { 'op' : ..., 'val' : ... }
+        # Assumes: nothing
+        # Effects: builds the dictionary the first time it is asked for
+        # Throws: nothing
+        # Notes: see processDisplayFields()
+
+        if self.cachedDisplayFields is None:
+            displayFields = {}
+            for key in list(self.parsedFields.keys()):
+                displayFields[key] = copyEntry(self.parsedFields[key])
+            self.cachedDisplayFields = processDisplayFields(displayFields,
+                self.nots)
+        return self.cachedDisplayFields
+
+    @displayFields.setter
+    def displayFields(self, displayFields):
+        # Purpose: replace the display version of the fields
+        self.cachedDisplayFields = displayFields
+
     def __getitem__(self, key):
         op = self.fields[key]['op']
         value = self.fields[key]['val']
@@ -286,10 +937,44 @@ class FieldStorage:
     def keys(self):
         return list(self.fields.keys())
 
+    def getSqlCondition(self, key, column, placeholder = '%s'):
+        # Purpose: get a parameterized SQL condition for field 'key',
+        #   comparing it with 'column'
+        # Returns: tuple of (SQL string, list of parameters); see
+        #   sqlCondition()
+        # Assumes: 'column' is a trusted SQL expression, not user input
+        # Effects: nothing
+        # Throws: KeyError if there is no field 'key'; 'error' as for
+        #   sqlCondition()
+        return sqlCondition(column, self.fields[key]['op'],
+            self.fields[key]['val'], placeholder)
+
 
     def has_key(self, key):
         return key in self.fields
 
+    def close(self):
+        # Purpose: remove the temp files of any list values which were
+        #   spilled to disk (see TokenSpool)
+        # Returns: nothing
+        # Assumes: nothing
+        # Effects: closes the TokenSpools in the fields; their tokens
+        #   beyond those kept in memory are no longer available
+        # Throws: nothing
+        entries = list(self.parsedFields.values()) + \
+            list(self.fields.values())
+        if self.cachedDisplayFields is not None:
+            entries = entries + list(self.cachedDisplayFields.values())
+        for entry in entries:
+            if isinstance(entry.get('val'), TokenSpool):
+                entry['val'].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
 
     def __repr__(self):
         s = '<dl>\n'
@@ -306,8 +991,9 @@ class FieldStorage:
             #       were actually submitted (not including the extra
             #       parsing or the default values handled in the
             #       constructor for mgi_cgi.FieldStorage)
-            # Returns: cgi.FieldStorage -- this is a copy, so you can
-            #       modify it without worrying about side effects
+            # Returns: cgi.FieldStorage, or a ParsedForm if the submission
+            #       was not read by the cgi module -- this is a copy, so
+            #       you can modify it without worrying about side effects
             # Assumes: nothing
             # Effects: nothing
             # Throws: nothing
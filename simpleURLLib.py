@@ -6,17 +6,409 @@
 """
 Simple Library for reading URLs.
 Simple readURL(url, ...) function
+Simple openURL(url, ...) and saveURL(url, filePath, ...) functions
+  - stream a response in chunks / straight to a file.
 Simple ThrottledURLReader class
   - read from URLs with a min number of seconds between reads.
+Simple TokenBucket class
+  - rate limiter that can be shared by ThrottledURLReaders, threads, and
+    (via a state file) processes on the same host.
+Simple ConnectionPool class
+  - keep-alive HTTP/HTTPS connections, reused by readURL() by default.
+Simple ResponseCache class
+  - optional on-disk cache of responses for readURL()/ThrottledURLReader.
+Simple AsyncURLReader class
+  - asyncio version of ThrottledURLReader.
+Simple RetryPolicy class
+  - retry w/ exponential backoff for ThrottledURLReader/AsyncURLReader.
 """
 
+import os
 import time
+import random
+import email.utils
+import asyncio
+import functools
+import hashlib
+import tempfile
+import zlib
+import threading
+import http.client
 import urllib.request, urllib.parse, urllib.error
+try:
+    import fcntl                # only needed for TokenBucket state files
+except ImportError:
+    fcntl = None
+
+USER_AGENT = 'Python-urllib/%s' % urllib.request.__version__
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10              # same as urllib
+ACCEPT_ENCODING = 'gzip, deflate'	# compressed responses we can decode
+READ_CHUNK_SIZE = 64 * 1024     # bytes to read from a response at a time
+
+# process umask, read once here since os.umask() can only be read by
+#  setting it, which would race with other threads creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+class URLReadError (Exception):
+    """
+    Raised by readURL() and the URL readers for url errors.
+    code is the HTTP status code, or None if we could not reach the server
+        (or get a response).
+    retryAfter is the seconds from the response's Retry-After header, or None
+    """
+    def __init__(self, msg, url, code=None, retryAfter=None):
+        Exception.__init__(self, msg)
+        self.url = url
+        self.code = code
+        self.retryAfter = retryAfter
+# -------------------------
+
+def getRetryAfter(headers,	# response headers (email.message.Message)
+            ):
+    """ Return the seconds (float) from the Retry-After header, or None.
+        The header can be seconds or an HTTP-date.
+    """
+    value = headers.get('Retry-After') if headers != None else None
+    if value == None: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+# -------------------------
+
+class Decompressor (object):
+    """
+    Streaming decoder for a response body w/ a Content-Encoding of gzip or
+        deflate (or none/identity, which is passed through).
+        decompress() each chunk as it is read, then flush() at the end.
+    """
+    def __init__(self,
+                contentEncoding=None,	# str, the Content-Encoding header
+                ):
+        encoding = (contentEncoding or 'identity').strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            # 32+ means detect a gzip or zlib header
+            self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            self.isDeflate = encoding == 'deflate'
+        elif encoding == 'identity':
+            self.decoder = None
+        else:
+            raise URLReadError("Unsupported Content-Encoding: '%s'\n" \
+                                                    % contentEncoding, None)
+        self.started = False
+    #------------------------
+
+    def decompress(self, chunk):
+        if self.decoder == None: return chunk
+        if not self.started and chunk:
+            self.started = True
+            if self.isDeflate:	# some servers send raw deflate, no header
+                try:
+                    return self.decoder.decompress(chunk)
+                except zlib.error:
+                    self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decoder.decompress(chunk)
+    #------------------------
+
+    def flush(self):
+        if self.decoder == None: return b''
+        return self.decoder.flush()
+    #------------------------
+
+# end class Decompressor -------------------------
+
+class URLStream (object):
+    """
+    A response body, read incrementally: a file-like object w/ read(), and
+        an iterator over chunks of the (decompressed) body (bytes).
+    Use it in a 'with' statement, or close() it when done, so its connection
+        is released. If the body is read to the end, the connection goes
+        back to the pool for reuse; if closed early, the connection is
+        closed.
+    Has url, status, and headers (of the response) attributes.
+    """
+    def __init__(self,
+                response,	# http.client.HTTPResponse (or urllib's)
+                url,		# str, URL of the response (after redirects)
+                decode=True,	# decompress according to Content-Encoding
+                release=None,	# function(reusable) to call when done
+                                #  None means just close the response
+                ):
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.decompressor = Decompressor(
+                    response.headers.get('Content-Encoding') if decode else None)
+        self.release = release
+        self.buffer = b''
+        self.eof = False
+        self.closed = False
+    #------------------------
+
+    def readChunk(self):
+        """ Return the next chunk of the body (bytes), b'' at the end.
+            (Chunks may be empty before the end, while decompressing.)
+        """
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b''
+            return chunk
+        if self.eof: return b''
+        try:
+            chunk = self.response.read(READ_CHUNK_SIZE)
+            if chunk:
+                return self.decompressor.decompress(chunk)
+            chunk = self.decompressor.flush()
+        except (OSError, http.client.HTTPException, zlib.error) as e:
+            self.finish(False)
+            raise URLReadError("Failed reading response, reason: %s\n" \
+                                    "URL: '%s'\n" % (e, self.url), self.url)
+        self.finish(True)
+        return chunk
+    #------------------------
+
+    def read(self,
+                n=-1,		# int, max num of bytes to return. -1 = all
+                ):
+        """ Return up to n bytes of the body, b'' at the end """
+        chunks = [self.buffer]
+        size = len(self.buffer)
+        self.buffer = b''
+        while (n < 0 or size < n) and not self.eof:
+            chunk = self.readChunk()
+            chunks.append(chunk)
+            size += len(chunk)
+        data = b''.join(chunks)
+        if n >= 0:
+            data, self.buffer = data[:n], data[n:]
+        return data
+    #------------------------
+
+    def __iter__(self):
+        """ Iterate over the (non-empty) chunks of the body """
+        while True:
+            chunk = self.readChunk()
+            if chunk:
+                yield chunk
+            elif self.eof and not self.buffer:
+                return
+    #------------------------
+
+    def finish(self, reusable):
+        """ Release the response/connection (once) """
+        if self.eof: return
+        self.eof = True
+        if self.release != None:
+            self.release(reusable)
+        else:
+            self.response.close()
+    #------------------------
+
+    def close(self):
+        """ Done w/ the body. If it is not all read, drop the connection """
+        self.finish(False)
+        self.buffer = b''
+        self.closed = True
+    #------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# end class URLStream -------------------------
+
+def addAcceptEncoding(headers,	# dict of request headers from the caller
+            ):
+    """ Return (headers, decode): headers w/ Accept-Encoding added so the
+            server can send a compressed response, and whether we should
+            decompress it. If the caller set Accept-Encoding themselves, we
+            leave it and the response body alone.
+    """
+    for name in headers:
+        if name.lower() == 'accept-encoding':
+            return headers, False
+    headers = dict(headers)
+    headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return headers, True
+# -------------------------
+
+class ConnectionPool (object):
+    """
+    Keeps idle keep-alive HTTP/HTTPS connections, keyed by (scheme, host),
+        so repeated requests to the same server skip the TCP connect and
+        TLS handshake.
+    Up to maxPerHost idle connections are kept per host; connections idle
+        longer than idleTimeout seconds are closed instead of reused.
+        More than maxPerHost connections can be open at once (e.g., by
+        several threads), the extras are closed when they are released.
+    Thread safe, but a connection is only used by one thread at a time.
+    """
+    def __init__(self,
+                maxPerHost=4,	# int, max idle connections kept per host
+                idleTimeout=30.0,	# float, seconds before an idle
+                                        #  connection is discarded
+                timeout=None,	# float, socket timeout for connections
+                                #  None means the socket default
+                ):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}		# (scheme, host) -> [(conn, idle since), ...]
+    #------------------------
+
+    def getConnection(self, scheme, host):
+        """ Return (conn, reused) - an idle connection for the host if
+            there is one, else a new (not yet connected) one.
+        """
+        key = (scheme, host)
+        now = time.monotonic()
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                conn, since = conns.pop()	# most recently used first
+                if now - since <= self.idleTimeout:
+                    return conn, True
+                conn.close()
+        kw = {}
+        if self.timeout != None: kw['timeout'] = self.timeout
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, **kw), False
+        elif scheme == 'http':
+            return http.client.HTTPConnection(host, **kw), False
+        raise URLReadError("Unsupported URL scheme: '%s'\n" % scheme, None)
+    #------------------------
+
+    def releaseConnection(self, scheme, host, conn):
+        """ Return conn to the pool for reuse, or close it if the pool
+            for the host is full.
+            Only release a connection after its response has been read.
+        """
+        key = (scheme, host)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxPerHost:
+                conns.append( (conn, time.monotonic()) )
+                return
+        conn.close()
+    #------------------------
+
+    def closeAll(self):
+        """ Close all idle connections """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn, since in conns:
+                conn.close()
+    #------------------------
+
+    def readURL(self, url,	# str, params already encoded
+                data=None,	# bytes to POST, or None to GET
+                headers={},
+                ):
+        """ Do the request and return the response body (bytes).
+            See open().
+        """
+        with self.open(url, data, headers) as stream:
+            return stream.read()
+    #------------------------
+
+    def open(self, url,		# str, params already encoded
+                data=None,	# bytes to POST, or None to GET
+                headers={},
+                ):
+        """ Do the request and return a URLStream for the response body.
+            Follows redirects, like urllib.
+            Raises URLReadError with helpful msges for url errors.
+        """
+        method = 'POST' if data != None else 'GET'
+        for i in range(MAX_REDIRECTS + 1):
+            stream = self.request(method, url, data, headers)
+            status = stream.status
+            if status in REDIRECT_CODES and 'Location' in stream.headers:
+                stream.read()			# so the connection can be reused
+                url = urllib.parse.urljoin(url, stream.headers['Location'])
+                if status == 303 or (status in (301, 302) and method=='POST'):
+                    method, data = 'GET', None	# what browsers/urllib do
+                continue
+            if status >= 400:
+                stream.close()
+                raise URLReadError("Cannot fulfill request, code: %s\n" \
+                                "URL: '%s'\n" % (status, url), url,
+                                code=status,
+                                retryAfter=getRetryAfter(stream.headers))
+            return stream
+        raise URLReadError("Too many redirects\nURL: '%s'\n" % url, url)
+    #------------------------
+
+    def request(self, method, url, data=None, headers={}):
+        """ Do one request (no redirects) on a pooled connection.
+            Return a URLStream for the response (of any status). The
+                connection is released when the stream is read or closed.
+            A reused connection that the server has since closed is
+                retried once on a new connection.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme, host = parts.scheme.lower(), parts.netloc
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+
+        allHeaders = {'User-Agent': USER_AGENT}
+        if data != None:
+            allHeaders['Content-Type'] = 'application/x-www-form-urlencoded'
+        allHeaders.update(headers)
+        allHeaders, decode = addAcceptEncoding(allHeaders)
+
+        while True:
+            conn, reused = self.getConnection(scheme, host)
+            try:
+                conn.request(method, path, body=data, headers=allHeaders)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError) as e:
+                conn.close()
+                if reused: continue		# stale, try a new one
+                raise URLReadError("Failed to reach server, reason: %s\n" \
+                                "URL: '%s'\n" % (e, url), url)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise URLReadError("Failed to reach server, reason: %s\n" \
+                                "URL: '%s'\n" % (e, url), url)
+
+            def release(reusable, conn=conn, response=response):
+                if reusable and not response.will_close:
+                    self.releaseConnection(scheme, host, conn)
+                else:
+                    conn.close()
+            try:
+                return URLStream(response, url, decode=decode,
+                                                        release=release)
+            except URLReadError:		# unsupported Content-Encoding
+                conn.close()
+                raise
+    #------------------------
+
+# end class ConnectionPool -------------------------
+
+defaultPool = ConnectionPool()		# used by readURL() by default
 
 def readURL(url,                # str
             GET=True,
             params=None,        # bytes if doing a post
             headers={},
+            pool=defaultPool,	# ConnectionPool for keep-alive connections
+                                #  None means a new connection via urllib
+            cache=None,		# ResponseCache to check/save responses in
             ):
     """ Return results (bytes) of the response from the URL.
         If params == None, we assume everything is encoded in the url.
@@ -25,39 +417,495 @@ def readURL(url,                # str
         Else do a post with params. 
 
         Can pass in http headers if you like.
-        Raises "Exception" with helpful msges for url errors.
+        Raises URLReadError (an Exception) with helpful msges for url errors.
+        Asks for a gzip/deflate compressed response & decompresses it
+            (unless you pass your own Accept-Encoding header).
+        Connections are reused from the pool unless pool is None, or a
+            proxy is configured in the environment (urllib handles those).
+        If a cache is given and has an unexpired response for the request,
+            that is returned without going to the server.
+    """
+    url, data = encodeRequest(url, GET=GET, params=params)
+
+    if cache != None:
+        responseText = cache.get(url, data)
+        if responseText != None: return responseText
+
+    responseText = fetchURL(url, data, headers=headers, pool=pool)
+
+    if cache != None:
+        cache.put(url, data, responseText)
+    return responseText
+# -------------------------
+
+def encodeRequest(url,          # str
+            GET=True,
+            params=None,        # bytes if doing a post
+            ):
+    """ Return (url, data) for the request as described in readURL() above.
+        data is the bytes to POST, or None for a GET.
     """
     data = params
     if params != None and GET == True: # need to encode params in the URL
         url = url + '?' +  urllib.parse.urlencode(params)
         data = None
+    return url, data
+# -------------------------
+
+def fetchURL(url,               # str, w/ any GET params encoded
+            data=None,          # bytes to POST, or None to GET
+            headers={},
+            pool=defaultPool,
+            ):
+    """ Return results (bytes) of the response from the URL.
+        The network part of readURL(), no cache.
+    """
+    with openEncodedURL(url, data, headers=headers, pool=pool) as stream:
+        return stream.read()
+# -------------------------
+
+def openURL(url,                # str
+            GET=True,
+            params=None,        # bytes if doing a post
+            headers={},
+            pool=defaultPool,	# ConnectionPool, see readURL() above
+            ):
+    """ Like readURL(), but return a URLStream to read the response body
+            from (in chunks, or as a file-like object), instead of the whole
+            body at once. Use it in a 'with' statement:
+                with openURL(url) as stream:
+                    for chunk in stream: ...
+        No cache.
+    """
+    url, data = encodeRequest(url, GET=GET, params=params)
+    return openEncodedURL(url, data, headers=headers, pool=pool)
+# -------------------------
 
+def openEncodedURL(url,         # str, w/ any GET params encoded
+            data=None,          # bytes to POST, or None to GET
+            headers={},
+            pool=defaultPool,
+            ):
+    """ Return a URLStream for the response from the URL.
+        The network part of openURL().
+    """
+    if pool != None and not urllib.request.getproxies():
+        return pool.open(url, data, headers)
+
+    headers, decode = addAcceptEncoding(headers)
     request = urllib.request.Request(url, data, headers )
     try:
         response = urllib.request.urlopen(request)
-        responseText = response.read()
+        return URLStream(response, response.geturl(), decode=decode)
+    except urllib.error.HTTPError as e:
+        raise URLReadError("Cannot fulfill request, code: %s\nURL: '%s'\n" \
+                                                % (e.code,url), url,
+                                code=e.code, retryAfter=getRetryAfter(e.headers))
     except urllib.error.URLError as e:
-        if hasattr(e, 'reason'):
-            raise Exception("Failed to reach server, reason: %s\nURL: '%s'\n" \
-                                                % (e.reason,url))
-        elif hasattr(e, 'code'):
-            raise Exception("Cannot fulfill request, code: %s\nURL: '%s'\n" \
-                                                % (e.code,url))
-    response.close()
+        raise URLReadError("Failed to reach server, reason: %s\nURL: '%s'\n" \
+                                                % (e.reason,url), url)
+# -------------------------
 
-    return responseText
+def saveURL(url,                # str
+            filePath,           # str, file to write the response body to
+            GET=True,
+            params=None,        # bytes if doing a post
+            headers={},
+            pool=defaultPool,	# ConnectionPool, see readURL() above
+            ):
+    """ Stream the response body from the URL to filePath.
+        The body is written to a temp file in the same directory that is
+            renamed to filePath when complete, so filePath is never partial.
+        Return the number of bytes written.
+    """
+    with openURL(url, GET=GET, params=params, headers=headers,
+                                                    pool=pool) as stream:
+        return writeStream(stream, filePath)
 # -------------------------
 
+def writeStream(stream,         # URLStream (or any iterable of bytes)
+            filePath,           # str
+            ):
+    """ Write the chunks from stream to a temp file and rename it to
+            filePath when complete.
+        Return the number of bytes written.
+    """
+    dirName = os.path.dirname(os.path.abspath(filePath))
+    fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in stream:
+                fp.write(chunk)
+                size += len(chunk)
+        setFileMode(tmpPath, filePath)
+        os.replace(tmpPath, filePath)
+    except:
+        os.unlink(tmpPath)
+        raise
+    return size
+# -------------------------
+
+def setFileMode(tmpPath,        # str, temp file from tempfile.mkstemp()
+            filePath,           # str, file it will replace
+            ):
+    """ Set the mode of tmpPath to that of the file it will replace, or if
+            there isn't one, to what open() would give a new file.
+        (mkstemp() creates files readable only by their owner.)
+    """
+    try:
+        mode = os.stat(filePath).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    os.chmod(tmpPath, mode)
+# -------------------------
+
+class ResponseCache (object):
+    """
+    On-disk cache of URL responses (bytes) for readURL() and
+        ThrottledURLReader, so repeated requests skip the server (and
+        the throttle).
+    Entries are keyed by a hash of the method, the normalized URL and the
+        POST params - with params in sorted order and excluding params
+        like the api_key that don't affect the response.
+    Each entry expires after a time-to-live, looked up in 'ttls' by the
+        last part of the URL path (e.g., 'efetch.fcgi'), else 'ttl'.
+        A ttl of 0 means responses for that URL are never cached.
+    Total size is kept under maxBytes by removing the least recently used
+        entries. Entries are written to a temp file then renamed, so
+        several processes can share a cacheDir. Entries get the usual
+        permissions for new files (0666 & ~umask), so processes run by
+        other users can share it too if the umask lets them write.
+    """
+    def __init__(self,
+                cacheDir,		# str, directory to keep responses in
+                ttl=3600,		# float, default seconds to keep entries
+                ttls={},		# {last part of URL path: ttl}
+                maxBytes=1024**3,	# int, max total size of entries
+                excludeParams=('api_key',),	# params not in the key
+                ):
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.ttls = ttls
+        self.maxBytes = maxBytes
+        self.excludeParams = excludeParams
+        self.lock = threading.Lock()
+        self.totalBytes = None	# estimate, None until the dir is scanned
+        os.makedirs(cacheDir, exist_ok=True)
+    #------------------------
+
+    def getTTL(self, url):
+        """ Return the ttl (seconds) for responses from url """
+        path = urllib.parse.urlsplit(url).path
+        return self.ttls.get(path.rstrip('/').split('/')[-1], self.ttl)
+    #------------------------
+
+    def getKey(self, url, data=None):
+        """ Return the cache key (hex str) for the request """
+        parts = urllib.parse.urlsplit(url)
+        query = self._normalizeParams(parts.query)
+        key = '%s %s://%s%s?%s' % ('GET' if data == None else 'POST',
+                parts.scheme.lower(), parts.netloc.lower(), parts.path, query)
+        if data != None:
+            key += '\n' + self._normalizeParams(data.decode('latin-1'))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+    #------------------------
+
+    def _normalizeParams(self, query):
+        params = [ (n, v) for (n, v) in
+                    urllib.parse.parse_qsl(query, keep_blank_values=True)
+                    if n.lower() not in self.excludeParams ]
+        return urllib.parse.urlencode(sorted(params))
+    #------------------------
+
+    def _getPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+    #------------------------
+
+    def get(self, url, data=None):
+        """ Return the cached response (bytes) for the request,
+            or None if it is not cached or has expired.
+        """
+        ttl = self.getTTL(url)
+        if ttl <= 0: return None
+        path = self._getPath(self.getKey(url, data))
+        try:
+            with open(path, 'rb') as fp:
+                stamp = float(fp.readline())	# time the entry was written
+                if time.time() - stamp > ttl: return None
+                responseText = fp.read()
+            os.utime(path)		# mtime = last used, for LRU
+        except (OSError, ValueError):	# not there, or just removed
+            return None
+        return responseText
+    #------------------------
+
+    def put(self, url, data, responseText):
+        """ Save the response (bytes) for the request (unless its ttl is 0)
+        """
+        if self.getTTL(url) <= 0: return
+        path = self._getPath(self.getKey(url, data))
+        dirName = os.path.dirname(path)
+        os.makedirs(dirName, exist_ok=True)
+
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(b'%r\n' % time.time())
+                fp.write(responseText)
+            setFileMode(tmpPath, path)
+            os.replace(tmpPath, path)
+        except:
+            os.unlink(tmpPath)
+            raise
+
+        with self.lock:
+            if self.totalBytes == None: self.totalBytes = self._scan()[0]
+            else: self.totalBytes += len(responseText)
+            if self.totalBytes > self.maxBytes:
+                self._evict()
+    #------------------------
+
+    def _scan(self):
+        """ Return (total bytes, [(mtime, size, path), ...]) of entries """
+        entries = []
+        total = 0
+        for sub in os.scandir(self.cacheDir):
+            if not sub.is_dir(): continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.tmp'): continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append( (st.st_mtime, st.st_size, entry.path) )
+                total += st.st_size
+        return total, entries
+    #------------------------
+
+    def _evict(self):
+        """ Remove least recently used entries until the total is under
+            90% of maxBytes (so we don't evict again on every put).
+        """
+        total, entries = self._scan()
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxBytes * 0.9: break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:		# another process got it
+                pass
+        self.totalBytes = total
+    #------------------------
+
+    def clear(self):
+        """ Remove all entries """
+        with self.lock:
+            for mtime, size, path in self._scan()[1]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self.totalBytes = 0
+    #------------------------
+
+# end class ResponseCache -------------------------
+
+class TokenBucket (object):
+    """
+    Token bucket rate limiter: tokens accumulate at 'rate' per second up to
+        'burst' tokens; each request takes a token, waiting if none is left.
+        So up to 'burst' requests can go at once, then 'rate' per second.
+    Thread safe: waiting threads reserve tokens in turn and sleep outside
+        the lock, so they are spaced out rather than all waking at once.
+    If statePath is given, the bucket state is kept in that file (locked
+        while it is updated), and all TokenBucket objects using the same
+        path - in any process on this host - share one budget.
+        (time.monotonic() is system-wide on Linux, so it can be shared.)
+    """
+    def __init__(self,
+                rate=2.0,	# float, tokens (requests) per second
+                burst=1,	# int, max tokens that can accumulate
+                statePath=None,	# file to share the bucket between processes
+                ):
+        self.rate = float(rate)
+        self.burst = burst
+        self.statePath = statePath
+        self.lock = threading.Lock()
+        self.tokens = float(burst)	# start full
+        self.stamp = time.monotonic()
+        if statePath != None and fcntl == None:
+            raise Exception("TokenBucket state files are not supported " \
+                                                    "on this platform\n")
+    #------------------------
+
+    def reserve(self,
+                n=1,		# number of tokens to take
+                ):
+        """ Take n tokens from the bucket, going into debt if necessary.
+            Return the number of seconds (float) to wait before the tokens
+            are really available (0.0 if they are available now).
+        """
+        tokens = self._update(lambda tokens: tokens - n)
+        if tokens >= 0: return 0.0
+        return -tokens / self.rate
+    #------------------------
+
+    def pause(self,
+                seconds,	# float
+                ):
+        """ Make sure no tokens are available for the next 'seconds',
+            e.g., when the server says we are going too fast.
+            Affects everyone sharing this bucket.
+        """
+        self._update(lambda tokens: min(tokens, -seconds * self.rate))
+    #------------------------
+
+    def acquire(self,
+                n=1,		# number of tokens to take
+                ):
+        """ Take n tokens from the bucket, sleeping until they are available
+        """
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+    #------------------------
+
+    def _update(self, func):
+        """ Refill the bucket up to now and then set the number of tokens
+            to func(tokens). Return the new number of tokens.
+        """
+        with self.lock:
+            if self.statePath == None:
+                self.tokens, self.stamp = self._refill(self.tokens,
+                                                            self.stamp)
+                self.tokens = func(self.tokens)
+                return self.tokens
+            else:
+                return self._updateShared(func)
+    #------------------------
+
+    def _refill(self, tokens, stamp):
+        """ Refill the bucket from (tokens, stamp) up to now.
+            Return the new (tokens, stamp).
+        """
+        now = time.monotonic()
+        tokens = min(float(self.burst), tokens + (now - stamp) * self.rate)
+        return tokens, now
+    #------------------------
+
+    def _updateShared(self, func):
+        """ Like _update(), but with the state kept in self.statePath.
+        """
+        fd = os.open(self.statePath, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)	# released by os.close()
+            try:
+                tokens, stamp = [float(x) for x in os.read(fd, 100).split()]
+            except ValueError:			# new or garbled, start full
+                tokens, stamp = float(self.burst), time.monotonic()
+            tokens, stamp = self._refill(tokens, stamp)
+            tokens = func(tokens)
+            state = b'%r %r\n' % (tokens, stamp)
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, state, 0)
+        finally:
+            os.close(fd)
+        return tokens
+    #------------------------
+
+# end class TokenBucket -------------------------
+
+class RetryPolicy (object):
+    """
+    When and how long to wait before retrying a failed request.
+    A failure is retried if it has one of the retryCodes HTTP status codes,
+        or if we could not reach the server (and retryConnectionErrors).
+    The wait before retry n (1, 2, ...) is backoff * 2**(n-1) seconds, up
+        to maxBackoff, less a random fraction (up to 'jitter') of that so
+        clients that failed together don't all retry together.
+        If the server sent Retry-After, we wait at least that long.
+    """
+    def __init__(self,
+                maxAttempts=5,	# int, max tries in all (1 = no retries)
+                backoff=1.0,	# float, seconds before the 1st retry
+                maxBackoff=60.0,	# float, max seconds between tries
+                jitter=0.5,	# float 0..1, max fraction to take off waits
+                retryCodes=(429, 500, 502, 503, 504),
+                retryConnectionErrors=True,
+                ):
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.retryCodes = retryCodes
+        self.retryConnectionErrors = retryConnectionErrors
+    #------------------------
+
+    def isRetryable(self, e,	# URLReadError
+                ):
+        if e.code == None: return self.retryConnectionErrors
+        return e.code in self.retryCodes
+    #------------------------
+
+    def getWait(self,
+                attempt,	# int, number of tries so far (1, 2, ...)
+                e,		# URLReadError from the last try
+                ):
+        """ Return seconds (float) to wait before trying again,
+            or None if we should give up and raise e.
+        """
+        if attempt >= self.maxAttempts or not self.isRetryable(e):
+            return None
+        wait = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+        wait -= wait * self.jitter * random.random()
+        if e.retryAfter != None:
+            wait = max(wait, e.retryAfter)
+        return wait
+    #------------------------
+
+# end class RetryPolicy -------------------------
+
 class ThrottledURLReader (object):
     """
     Provides a "read from a URL" method with a specified number (float) of
         seconds between reads so we don't overwhelm our welcome at a site.
+    By default each reader has its own TokenBucket allowing 1/seconds reads
+        per second (no bursts). Pass a limiter to use a different rate or
+        burst, or to share one budget across several readers/processes.
+    Safe to share across threads: several reads can be in progress at once
+        while the overall rate is kept.
     """
     def __init__(self,
-                seconds=0.5	# float, minimum num of seconds between reads
+                seconds=0.5,	# float, minimum num of seconds between reads
+                limiter=None,	# TokenBucket to use instead of 'seconds'
+                pool=defaultPool,	# ConnectionPool, see readURL() above
+                cache=None,	# ResponseCache, see readURL() above
+                retryPolicy=None,	# RetryPolicy, None means no retries
                 ):
         self.minSeconds = seconds
-        self.lastReadTime = 0.0	# initial last read was the beginning of time!
+        if limiter == None and seconds > 0:
+            limiter = TokenBucket(rate=1.0/seconds, burst=1)
+        self.limiter = limiter
+        self.pool = pool
+        self.cache = cache
+        self.retryPolicy = retryPolicy
+    #------------------------
+
+    def handleError(self, attempt, e):
+        """ Return seconds to wait before retrying after URLReadError e,
+            or None to give up.
+            Each retry waits for the limiter like any other request, and
+            if the server says we are going too fast (429 or Retry-After),
+            the whole limiter is paused so everyone sharing it backs off.
+        """
+        if self.retryPolicy == None: return None
+        wait = self.retryPolicy.getWait(attempt, e)
+        if wait != None and self.limiter != None and \
+                                (e.code == 429 or e.retryAfter != None):
+            self.limiter.pause(wait)
+        return wait
     #------------------------
 
     def readURL(self, url,
@@ -65,20 +913,135 @@ class ThrottledURLReader (object):
                 params=None,
                 headers={},
                 ):
-        """ see readURL() above"""
-        secondsSinceLast = time.time() - self.lastReadTime
-        if secondsSinceLast < self.minSeconds:
-            #print "sleeping for %10.7f" % (self.minSeconds - secondsSinceLast)
-            time.sleep(self.minSeconds - secondsSinceLast)
+        """ see readURL() above. Cache hits are not throttled."""
+        url, data = encodeRequest(url, GET=GET, params=params)
+
+        if self.cache != None:
+            output = self.cache.get(url, data)
+            if output != None: return output
 
-        output = readURL(url, GET=GET, params=params, headers=headers)
-        self.lastReadTime = time.time()
+        output = self.callWithRetries(fetchURL, url, data, headers=headers,
+                                                            pool=self.pool)
 
+        if self.cache != None:
+            self.cache.put(url, data, output)
         return output
     #------------------------
 
+    def openURL(self, url,
+                GET=True,
+                params=None,
+                headers={},
+                ):
+        """ see openURL() above. Throttled and retried (until the stream is
+            returned; failures while reading the stream are not retried).
+        """
+        url, data = encodeRequest(url, GET=GET, params=params)
+        return self.callWithRetries(openEncodedURL, url, data,
+                                            headers=headers, pool=self.pool)
+    #------------------------
+
+    def saveURL(self, url,
+                filePath,
+                GET=True,
+                params=None,
+                headers={},
+                ):
+        """ see saveURL() above. Throttled and retried like openURL(). """
+        with self.openURL(url, GET=GET, params=params,
+                                                headers=headers) as stream:
+            return writeStream(stream, filePath)
+    #------------------------
+
+    def callWithRetries(self, func, *args, **kw):
+        """ Return func(*args, **kw), waiting for the limiter before each
+            try, and retrying URLReadErrors per the retryPolicy.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter != None:
+                self.limiter.acquire()
+            try:
+                return func(*args, **kw)
+            except URLReadError as e:
+                wait = self.handleError(attempt, e)
+                if wait == None: raise
+                time.sleep(wait)
+    #------------------------
+
 # end class ThrottledURLReader -------------------------
 
+class AsyncURLReader (object):
+    """
+    asyncio version of ThrottledURLReader: 'await reader.readURL(...)'.
+    Waiting for the rate limit is done on the event loop; the requests
+        themselves are done on the loop's executor (thread pool) using the
+        ConnectionPool, so many requests can be in progress at once from
+        one event loop.
+    The limiter, pool, and cache can be shared with ThrottledURLReaders
+        (and other AsyncURLReaders) so they all keep one request budget.
+    """
+    def __init__(self,
+                seconds=0.5,	# float, minimum num of seconds between reads
+                limiter=None,	# TokenBucket to use instead of 'seconds'
+                pool=defaultPool,	# ConnectionPool, see readURL() above
+                cache=None,	# ResponseCache, see readURL() above
+                executor=None,	# concurrent.futures.Executor to do
+                                #  requests in. None = loop's default
+                retryPolicy=None,	# RetryPolicy, None means no retries
+                ):
+        self.minSeconds = seconds
+        if limiter == None and seconds > 0:
+            limiter = TokenBucket(rate=1.0/seconds, burst=1)
+        self.limiter = limiter
+        self.pool = pool
+        self.cache = cache
+        self.executor = executor
+        self.retryPolicy = retryPolicy
+    #------------------------
+
+    handleError = ThrottledURLReader.handleError	# same retry/limiter logic
+
+    async def readURL(self, url,
+                GET=True,
+                params=None,
+                headers={},
+                ):
+        """ see readURL() above. Cache hits are not throttled."""
+        loop = asyncio.get_running_loop()
+        url, data = encodeRequest(url, GET=GET, params=params)
+
+        if self.cache != None:
+            output = await loop.run_in_executor(self.executor,
+                                                self.cache.get, url, data)
+            if output != None: return output
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter != None:
+                wait = self.limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                output = await loop.run_in_executor(self.executor,
+                            functools.partial(fetchURL, url, data,
+                                            headers=headers, pool=self.pool))
+                break
+            except URLReadError as e:
+                wait = self.handleError(attempt, e)
+                if wait == None: raise
+                await asyncio.sleep(wait)
+
+        if self.cache != None:
+            await loop.run_in_executor(self.executor,
+                                        self.cache.put, url, data, output)
+        return output
+    #------------------------
+
+# end class AsyncURLReader -------------------------
+
 if __name__ == "__main__":	# test code
     r = ThrottledURLReader(seconds=0.5)
     for i in [1,2,3,4]:
@@ -86,3 +1049,9 @@ if __name__ == "__main__":	# test code
         print("read %d, time: %10.7f" % (i,time.time()))
         print(x[:100])
 
+    # 2 reads right away, then 1 per second
+    r = ThrottledURLReader(limiter=TokenBucket(rate=1.0, burst=2))
+    for i in [1,2,3,4]:
+        x = r.readURL("http://python.org")
+        print("read %d, time: %10.7f" % (i,time.time()))
+
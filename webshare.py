@@ -1,7 +1,18 @@
 # Name: webshare.py
 # Purpose: provide access to info about shared web components (images, css,
 #       etc.) as defined by an RcdFile.
-
+# Notes: Parsing the RcdFile is a noticeable part of the startup cost of each
+#       CGI script, so the parsed and validated definitions are saved in a
+#       compiled cache file next to the RcdFile (see CACHE_SUFFIX) and loaded
+#       from there while the RcdFile is unchanged.  Long-running processes
+#       should use getSharedComponents(), which shares one SharedComponents
+#       object per RcdFile and reloads it when the file changes.
+
+import os
+import time
+import marshal
+import tempfile
+import threading
 import rcdlib
 import urllib.request, urllib.parse, urllib.error
 
@@ -17,6 +28,39 @@ READING_ERROR = 'Could not read successfully from %s'
 MISSING_FIELD = 'In %s, entry for %s is missing required field %s'
 SPACE_ERROR = 'Invalid space character found in %s field: "%s"'
 
+# the compiled cache for an RcdFile is in a file with this suffix:
+
+CACHE_SUFFIX = '.cache'
+
+# version of the compiled cache format; bump this whenever what is saved in
+# the cache changes, so older cache files are ignored:
+
+CACHE_VERSION = 1
+
+# default number of seconds between checks of whether an RcdFile has changed,
+# for getSharedComponents():
+
+CHECK_INTERVAL = 10
+
+# number of times getSharedComponents() tries to load an RcdFile which is
+# changing while it is being read, before settling for what it got:
+
+LOAD_ATTEMPTS = 3
+
+###--------------------------------###
+###--- private global variables ---###
+###--------------------------------###
+
+# maps from an RcdFile path to a tuple of (SharedComponents loaded from it,
+# its getFileKey() when loaded, time.monotonic() of the last check for
+# changes); each entry is replaced as a whole, never changed in place
+
+registry = {}
+
+# held while loading an RcdFile for 'registry'
+
+registryLock = threading.Lock()
+
 ###-------------------------###
 ###--- private functions ---###
 ###-------------------------###
@@ -44,6 +88,179 @@ def getConfig (url):
         configCGI =  urllib.request.urlopen(url)
         return configCGI.readlines()
 
+def getFileKey (
+        filepath        # string; path to a file
+        ):
+        # Purpose: get a value which changes when the file at 'filepath' is
+        #       modified or replaced
+        # Returns: tuple of (modification time in ns, size, inode)
+        # Assumes: nothing
+        # Effects: queries the file system
+        # Throws: OSError if 'filepath' cannot be stat-ed
+
+        info = os.stat (filepath)
+        return (info.st_mtime_ns, info.st_size, info.st_ino)
+
+def parseRcdFile (
+        filepath        # string; path to the RcdFile which defines the
+                        # ...shared web components
+        ):
+        # Purpose: read and validate the RcdFile at 'filepath'
+        # Returns: tuple of (entries, aliasToName), where 'entries' maps
+        #       each name to a tuple of its fields: (url, height, width,
+        #       altTag, list of aliases) -- the optional fields are None if
+        #       not defined -- and 'aliasToName' maps each alias to its name
+        # Assumes: nothing
+        # Effects: reads from 'filepath' in the file system
+        # Throws: 'error' if any errors occur
+
+        # load the RcdFile from the path given
+
+        try:
+                rcdfile = rcdlib.RcdFile (filepath, rcdlib.Rcd, 'name')
+        except Exception as message:
+                raise Exception(RCDFILE_ERROR % (filepath, str(message)))
+
+        # each name or alias cited in the RcdFile should appear as a
+        # key in 'namesAliases' so that we can use it to check for
+        # duplicates.  Initialize it to start with all the names.
+
+        namesAliases = {}
+        for name in list(rcdfile.keys()):
+                if hasSpace(name):
+                        raise Exception(SPACE_ERROR % ('name', name))
+                namesAliases[name] = 1
+
+        entries = {}
+        aliasToName = {}
+
+        # walk through each defined rcd (one per shared component):
+
+        for (name, rcd) in list(rcdfile.items()):
+
+                # check for the required 'url' field
+
+                url = rcd['url']
+                if not url:
+                        raise Exception(MISSING_FIELD % (filepath, name, 'url'))
+
+                # go through any aliases: checking for duplication and
+                # mapping them to the name
+
+                aliases = []
+                for alias in rcd.getAsList('alias'):
+                        if alias in namesAliases:
+                                raise Exception(DUPLICATE_ALIAS % alias)
+                        if hasSpace(alias):
+                                raise Exception(SPACE_ERROR % ('alias', alias))
+
+                        aliasToName[alias] = name
+                        aliases.append (alias)
+                        namesAliases[alias] = 1
+
+                # the optional height, width, and alt fields are None if not
+                # defined
+
+                entries[name] = (url, rcd['height'] or None,
+                        rcd['width'] or None, rcd['alt'] or None, aliases)
+
+        return entries, aliasToName
+
+def readCache (
+        filepath,       # string; path to the RcdFile
+        fileKey         # tuple; from getFileKey(filepath)
+        ):
+        # Purpose: load the compiled cache for the RcdFile at 'filepath'
+        # Returns: tuple (entries, aliasToName) as from parseRcdFile(), or
+        #       None if there is no usable cache -- it is missing, corrupt,
+        #       from another CACHE_VERSION, or older than the RcdFile
+        # Assumes: nothing
+        # Effects: reads from the file system
+        # Throws: nothing
+
+        try:
+                fp = open (filepath + CACHE_SUFFIX, 'rb')
+                try:
+                        version, key, entries, aliasToName = marshal.load (fp)
+                finally:
+                        fp.close()
+        except Exception:
+                return None
+
+        if version != CACHE_VERSION or tuple(key) != fileKey:
+                return None
+        return entries, aliasToName
+
+def writeCache (
+        filepath,       # string; path to the RcdFile
+        fileKey,        # tuple; from getFileKey(filepath)
+        entries,        # dictionary; as from parseRcdFile()
+        aliasToName     # dictionary; as from parseRcdFile()
+        ):
+        # Purpose: save the compiled cache for the RcdFile at 'filepath'
+        # Returns: nothing
+        # Assumes: nothing
+        # Effects: writes to a temp file in the RcdFile's directory, then
+        #       renames it into place so readers never see a partial cache
+        # Throws: nothing; if the cache cannot be written (eg- the directory
+        #       is not writable) we just go without
+
+        cachePath = filepath + CACHE_SUFFIX
+        try:
+                fd, tempPath = tempfile.mkstemp (prefix = '.webshare',
+                        dir = os.path.dirname(cachePath) or '.')
+        except OSError:
+                return
+        try:
+                fp = os.fdopen (fd, 'wb')
+                try:
+                        marshal.dump ((CACHE_VERSION, fileKey, entries,
+                                aliasToName), fp)
+                finally:
+                        fp.close()
+                os.chmod (tempPath, 0o644)
+                os.replace (tempPath, cachePath)
+        except Exception:
+                try:
+                        os.remove (tempPath)
+                except OSError:
+                        pass
+        return
+
+def loadRcdFile (
+        filepath,       # string; path to the RcdFile
+        useCache        # boolean; use (and update) the compiled cache?
+        ):
+        # Purpose: get the validated definitions from the RcdFile at
+        #       'filepath', from its compiled cache if that is current
+        # Returns: tuple (entries, aliasToName) as from parseRcdFile()
+        # Assumes: nothing
+        # Effects: reads from the file system; may write the compiled cache
+        # Throws: 'error' if any errors occur
+
+        if not useCache:
+                return parseRcdFile (filepath)
+
+        try:
+                fileKey = getFileKey (filepath)
+        except OSError:
+                return parseRcdFile (filepath)  # let rcdlib report it
+
+        cached = readCache (filepath, fileKey)
+        if cached:
+                return cached
+
+        entries, aliasToName = parseRcdFile (filepath)
+
+        # only save the cache if the file did not change while we read it
+
+        try:
+                if getFileKey (filepath) == fileKey:
+                        writeCache (filepath, fileKey, entries, aliasToName)
+        except OSError:
+                pass
+        return entries, aliasToName
+
 ###----------------------###
 ###--- public classes ---###
 ###----------------------###
@@ -91,6 +308,11 @@ class SharedComponent:
 
                 # string; value for the ALT attribute of this SharedComponent
                 self.altTag = None
+
+                # maps from a kind of tag ('img', 'css', or 'html') to the
+                # HTML tag (string) of that kind already built for this
+                # SharedComponent; cleared whenever a field changes
+                self.tags = {}
                 return
 
         def addAlias (self,
@@ -122,6 +344,7 @@ class SharedComponent:
                 # Notes: PRIVATE.
 
                 self.height = height
+                self.tags = {}
                 return
 
         def setWidth (self,
@@ -136,6 +359,7 @@ class SharedComponent:
                 # Notes: PRIVATE.
 
                 self.width = width
+                self.tags = {}
                 return
 
         def setAltTag (self,
@@ -151,6 +375,7 @@ class SharedComponent:
                 # Notes: PRIVATE.
 
                 self.altTag = altTag
+                self.tags = {}
                 return
 
         ###----------------------###
@@ -232,7 +457,11 @@ class SharedComponent:
                 # Throws: nothing
                 # Notes: If you'd rather not call this directly, you may use
                 #       self.getHtmlTag() in case this component is a style
-                #       sheet.
+                #       sheet.  The tag is only built once, unless the
+                #       height, width, or ALT attribute changes.
+
+                if 'img' in self.tags:
+                        return self.tags['img']
 
                 # start with the required piece
                 parts = [ 'IMG SRC="%s" BORDER=0' % self.url ]
@@ -248,7 +477,8 @@ class SharedComponent:
 
                 # build and return the complete tag
 
-                return '<%s>' % ' '.join(parts)
+                self.tags['img'] = '<%s>' % ' '.join(parts)
+                return self.tags['img']
 
         def getStyleSheetTag (self):
                 # Purpose: get an HTML <LINK...> tag which loads this
@@ -260,7 +490,9 @@ class SharedComponent:
                 # Notes: If you'd rather not call this directly, you may use
                 #       self.getHtmlTag() in case this component is an image.
 
-                return '<LINK REL="stylesheet" HREF="%s" TYPE="text/css">' % self.url
+                if 'css' not in self.tags:
+                        self.tags['css'] = '<LINK REL="stylesheet" HREF="%s" TYPE="text/css">' % self.url
+                return self.tags['css']
 
         def getHtmlTag (self):
                 # Purpose: get the HTML tag appropriate for this component
@@ -273,12 +505,17 @@ class SharedComponent:
                 #       then we assume this component is a style-sheet.
                 #       Otherwise, we assume it is an image.
 
+                if 'html' in self.tags:
+                        return self.tags['html']
+
                 pos = self.url.rfind ('.')
-                if pos != -1:
-                        if self.url[pos:].lower() == '.css':
-                                return self.getStyleSheetTag()
+                if pos != -1 and self.url[pos:].lower() == '.css':
+                        tag = self.getStyleSheetTag()
+                else:
+                        tag = self.getImgTag()
 
-                return self.getImgTag()
+                self.tags['html'] = tag
+                return tag
 
         def getRcd (self):
                 # Purpose: get a string representing this SharedComponent as
@@ -324,90 +561,75 @@ class SharedComponents:
         #       exception will be raised at the time of instantiation.
 
         def __init__ (self,
-                filepath        # string; path to the RcdFile which defines
+                filepath,       # string; path to the RcdFile which defines
                                 # ...the shared web components
+                useCache = True,# boolean; load the definitions from the
+                                # ...compiled cache (if it is current), and
+                                # ...update the cache if it is not?
+                lazy = False    # boolean; only create each SharedComponent
+                                # ...when it is first asked for?
                 ):
                 # Purpose: constructor
                 # Returns: nothing
                 # Assumes: nothing
-                # Effects: reads from 'filepath' in the file system
+                # Effects: reads from 'filepath' in the file system; may
+                #       write a compiled cache file next to it
                 # Throws: 'error' if any errors occur
-
-                # maps from an alias (string) to the preferred name (string)
-                # for its SharedComponent
-                self.aliasToName = {}
-
-                # maps from a name (string) to its associated SharedComponent
-                self.nameToComponent = {}
+                # Notes: A page typically uses only a few of the components,
+                #       so CGI scripts can save time and memory by using
+                #       'lazy' mode.  Either way, all the definitions are
+                #       read and validated here.
 
                 # string; path to the RcdFile with the definitions
                 self.rcdFilePath = filepath
 
-                # load the RcdFile from the path given
-
-                try:
-                        rcdfile = rcdlib.RcdFile (filepath, rcdlib.Rcd, 'name')
-                except message:
-                        raise Exception(RCDFILE_ERROR % (filepath, str(message)))
-
-                # each name or alias cited in the RcdFile should appear as a
-                # key in 'namesAliases' so that we can use it to check for
-                # duplicates.  Initialize it to start with all the names.
-
-                namesAliases = {}
-                for name in list(rcdfile.keys()):
-                        if hasSpace(name):
-                                raise Exception(SPACE_ERROR % ('name', name))
-                        namesAliases[name] = 1
-
-                # walk through each defined rcd (one per shared component):
-
-                for (name, rcd) in list(rcdfile.items()):
-
-                        # check for the required 'url' field
-
-                        url = rcd['url']
-                        if not url:
-                                raise Exception(MISSING_FIELD % (
-                                                filepath, name, 'url'))
-
-                        # instantiate a new SharedComponent
-
-                        component = SharedComponent (name, url)
-
-                        # go through any aliases: checking for duplication,
-                        # mapping them to the name, and adding them to the
-                        # 'component'
+                # maps from a name (string) to the tuple of fields for its
+                # SharedComponent, as from parseRcdFile(); and from an alias
+                # (string) to the preferred name (string) for its
+                # SharedComponent
+                self.entries, self.aliasToName = loadRcdFile (filepath,
+                        useCache)
 
-                        aliases = rcd.getAsList('alias')
-                        for alias in aliases:
-                                if alias in namesAliases:
-                                        raise Exception(DUPLICATE_ALIAS % alias)
-                                if hasSpace(alias):
-                                        raise Exception(SPACE_ERROR % ('alias',
-                                                alias))
+                # maps from a name (string) to its associated SharedComponent,
+                # for those created so far
+                self.nameToComponent = {}
 
-                                self.aliasToName[alias] = name
-                                component.addAlias(alias)
-                                namesAliases[alias] = 1 
+                # string; contents of the RcdFile, once read by getRcdFile()
+                self.rcdFileContents = None
 
-                        # handle the optional height, width, and alt fields
+                if not lazy:
+                        for name in self.entries:
+                                self.getComponent (name)
+                return
 
-                        height = rcd['height']
-                        width = rcd['width']
-                        altTag = rcd['alt']
+        def getComponent (self,
+                name            # string; preferred name of a SharedComponent
+                ):
+                # Purpose: get the SharedComponent for 'name', creating it
+                #       from its fields the first time
+                # Returns: SharedComponent
+                # Assumes: 'name' is in self.entries
+                # Effects: remembers the new SharedComponent in
+                #       self.nameToComponent
+                # Throws: nothing
+                # Notes: PRIVATE.
 
-                        if height:
-                                component.setHeight(height)
-                        if width:
-                                component.setWidth(width)
-                        if altTag:
-                                component.setAltTag(altTag)
+                if name in self.nameToComponent:
+                        return self.nameToComponent[name]
 
-                        # associate the complete 'component' with its 'name'
+                (url, height, width, altTag, aliases) = self.entries[name]
+                component = SharedComponent (name, url)
+                for alias in aliases:
+                        component.addAlias(alias)
+                if height:
+                        component.setHeight(height)
+                if width:
+                        component.setWidth(width)
+                if altTag:
+                        component.setAltTag(altTag)
 
-                        self.nameToComponent[name] = component
-                return
+                self.nameToComponent[name] = component
+                return component
 
         def get (self,
                 nameOrAlias     # string; name or alias for a SharedComponent
@@ -417,23 +639,45 @@ class SharedComponents:
                 # Returns: SharedCompoment, or None if one is not associated
                 #       with 'nameOrAlias'
                 # Assumes: nothing
-                # Effects: nothing
+                # Effects: in lazy mode, creates the SharedComponent if this
+                #       is the first time it was asked for
                 # Throws: nothing
 
                 # first check for a direct association by name
 
-                if nameOrAlias in self.nameToComponent:
-                        return self.nameToComponent[nameOrAlias]
+                if nameOrAlias in self.entries:
+                        return self.getComponent (nameOrAlias)
 
                 # failing that, look for an alias which is mapped to a name
                 # we can use to look up a SharedComponent
 
                 if nameOrAlias in self.aliasToName:
-                        name = self.aliasToName[nameOrAlias]
-                        return self.nameToComponent[name]
+                        return self.getComponent (self.aliasToName[nameOrAlias])
 
                 return None             # 'nameOrAlias' was unknown
 
+        def getHtmlTags (self,
+                namesOrAliases  # list of strings; each a name or alias for
+                                # ...a SharedComponent
+                ):
+                # Purpose: get the HTML tags for several SharedComponents at
+                #       once
+                # Returns: list with one item for each of 'namesOrAliases',
+                #       in the same order: its SharedComponent's getHtmlTag(),
+                #       or None if it is unknown
+                # Assumes: nothing
+                # Effects: see get()
+                # Throws: nothing
+
+                tags = []
+                for nameOrAlias in namesOrAliases:
+                        component = self.get (nameOrAlias)
+                        if component:
+                                tags.append (component.getHtmlTag())
+                        else:
+                                tags.append (None)
+                return tags
+
         def getNames (self):
                 # Purpose: get a list of preferred names for SharedComponent
                 #       objects
@@ -443,7 +687,7 @@ class SharedComponents:
                 # Effects: nothing
                 # Throws: nothing
 
-                return list(self.nameToComponent.keys())
+                return list(self.entries.keys())
 
         def getAliases (self):
                 # Purpose: get a list of non-preferred names for
@@ -462,14 +706,113 @@ class SharedComponents:
                 # Returns: string; contents of the original RcdFile joined
                 #       into a single string.
                 # Assumes: nothing
-                # Effects: re-reads the file from the file system
+                # Effects: re-reads the file from the file system the first
+                #       time it is called, and remembers its contents
                 # Throws: 'error' if we have problems re-reading the file
 
+                if self.rcdFileContents is None:
+                        try:
+                                fp = open (self.rcdFilePath, 'r')
+                                lines = fp.readlines()
+                                fp.close()
+                        except:
+                                raise Exception(READING_ERROR %
+                                        self.rcdFilePath)
+                        self.rcdFileContents = ''.join(lines)
+
+                return self.rcdFileContents
+
+###------------------------###
+###--- public functions ---###
+###------------------------###
+
+def loadSharedComponents (
+        filepath                # string; path to the RcdFile which defines
+                                # ...the shared web components
+        ):
+        # Purpose: load a SharedComponents (in lazy mode) for 'filepath',
+        #       along with the file's contents for its getRcdFile(), making
+        #       sure both come from the same version of the file
+        # Returns: tuple of (SharedComponents, getFileKey() of the file
+        #       they were loaded from) -- the key is None if the file kept
+        #       changing while we loaded it, so it will be loaded again at
+        #       the next check
+        # Assumes: nothing
+        # Effects: reads from the file system
+        # Throws: 'error' if the RcdFile cannot be loaded
+        # Notes: PRIVATE; for getSharedComponents().
+
+        for i in range(LOAD_ATTEMPTS):
+                fileKey = getFileKey (filepath)
+                components = SharedComponents (filepath, lazy = True)
+                components.getRcdFile()
+                if getFileKey (filepath) == fileKey:
+                        return components, fileKey
+        return components, None
+
+def getSharedComponents (
+        filepath,               # string; path to the RcdFile which defines
+                                # ...the shared web components
+        checkInterval = CHECK_INTERVAL  # number; seconds to wait between
+                                # ...checks for changes to the RcdFile
+        ):
+        # Purpose: get the process-wide SharedComponents for 'filepath',
+        #       reloading it if the file has been changed or replaced
+        # Returns: SharedComponents (in lazy mode)
+        # Assumes: nothing
+        # Effects: reads from the file system at most once per
+        #       'checkInterval' seconds, to check the file and (if it
+        #       changed) to load it
+        # Throws: 'error' if the RcdFile cannot be loaded the first time;
+        #       after that, if a changed RcdFile cannot be loaded we keep
+        #       using the one we have, and try again after 'checkInterval'
+        # Notes: Use this in long-running (FastCGI/WSGI) processes rather
+        #       than building a new SharedComponents, and call it for each
+        #       request rather than holding onto its result, so new
+        #       definitions are picked up.  A reload builds a new
+        #       SharedComponents and then swaps it in, so other threads
+        #       are not blocked; they keep using the old one until then.
+        #       Its getRcdFile() contents are read as part of the same load,
+        #       so they always match the definitions it serves.
+
+        entry = registry.get (filepath)
+        now = time.monotonic()
+        if entry:
+                components, fileKey, lastCheck = entry
+                if now - lastCheck < checkInterval:
+                        return components
+
+                # only one thread needs to check and reload; the others can
+                # go on using what we have
+
+                if not registryLock.acquire (False):
+                        return components
+        else:
+                lastCheck = None
+                registryLock.acquire()
+
+        try:
+                entry = registry.get (filepath)
+                if entry and entry[2] != lastCheck:
+                        return entry[0]         # another thread just did it
+
                 try:
-                        fp = open (self.rcdFilePath, 'r')
-                        lines = fp.readlines()
-                        fp.close()
-                except:
-                        raise Exception(READING_ERROR % self.rcdFilePath)
+                        newKey = getFileKey (filepath)
+                except OSError:
+                        newKey = None
+                if entry and newKey is not None and newKey == entry[1]:
+                        registry[filepath] = (entry[0], entry[1], now)
+                        return entry[0]
 
-                return ''.join(lines)
+                try:
+                        components, newKey = loadSharedComponents (filepath)
+                except Exception:
+                        if not entry:
+                                raise
+                        registry[filepath] = (entry[0], entry[1], now)
+                        return entry[0]
+
+                registry[filepath] = (components, newKey, now)
+                return components
+        finally:
+                registryLock.release()
@@ -4,50 +4,144 @@
 # consists of an Rcd file which we will store locally within the WI.
 
 import sys
-import string
 import httpReader
 import os
+import tempfile
+
+# validators from the last download are kept in a file with this suffix next
+# to the rcd file, so we can ask the webshare product for the file only if it
+# has changed
+
+VALIDATOR_SUFFIX = '.validators'
+VALIDATOR_HEADERS = [ ('ETag', 'If-None-Match'),
+    ('Last-Modified', 'If-Modified-Since') ]
+
+
+def readValidators(filePath) :
+
+# return a dictionary of response header -> value from the last download of
+# 'filePath', or an empty one if we have none (or the file itself is gone)
+
+    validators = {}
+    if not os.path.exists(filePath):
+        return validators
+    try:
+        f = open(filePath + VALIDATOR_SUFFIX, 'r')
+        for line in f.readlines():
+            if ':' in line:
+                name, value = line.split(':', 1)
+                validators[name.strip()] = value.strip()
+        f.close()
+    except IOError:
+        pass
+    return validators
+
+
+def writeValidators(filePath, reader) :
+
+# save the validators from the response 'reader' just got for 'filePath'
+
+    validatorPath = filePath + VALIDATOR_SUFFIX
+    lines = []
+    for name, requestHeader in VALIDATOR_HEADERS:
+        value = reader.getResponseHeader(name)
+        if value:
+            lines.append('%s: %s\n' % (name, value))
+    try:
+        if lines:
+            f = open(validatorPath, 'w')
+            f.writelines(lines)
+            f.close()
+        elif os.path.exists(validatorPath):
+            os.remove(validatorPath)
+    except (IOError, OSError):
+        # only costs us a full download next time
+        print("Could not save %s" % validatorPath)
 
 
 def saveWebshare(filePath, baseURL) :
 
-# open the output file for writing
+# download the rcd file to 'filePath' if it has changed since we last did.
+# The new file is written to a temp file in the same directory and renamed
+# into place, so readers never see a half-written rcd file.
+
+    url = os.path.join(baseURL, 'components.cgi?format=rcd')
+
+    reader = httpReader.httpReader (url)
+    validators = readValidators(filePath)
+    for name, requestHeader in VALIDATOR_HEADERS:
+        reader.setHeader (requestHeader, validators.get(name))
+
+# open the temp file for writing
 
     try:
-        f = open(filePath, "w")
+        fd, tempPath = tempfile.mkstemp (prefix = '.webshare',
+            dir = os.path.dirname(filePath) or '.')
+        f = os.fdopen(fd, "w")
     except:
         print("Error opening data/webshare.rcd file")
         sys.exit(1)
 
     f.write('# Note: This file is machine-generated, do not edit!\n')
 
-    url = os.path.join(baseURL, 'components.cgi?format=rcd')
-
     try:
-        lines, errors = httpReader.getURL (url)
-        if errors:
-            print("Errors occurred when reading from webshare product:")
-            for error in errors:
-                print("    " + error)
-            raise IOError
-
         # HTTP headers come down with the response, so we need to skip down
         # until we get past the blank line which separates the headers from
-        # the body
+        # the body.  Lines are streamed to the file as they arrive; we only
+        # need to hold onto those before the first blank line.
+
+        header = []
+        inBody = False
+        for line in reader.iterLines ():
+            line = line.strip()
+            if inBody:
+                f.write(line + '\n')
+            elif line == '':
+                header = []
+                inBody = True
+            else:
+                header.append (line)
 
-        lines = list(map (string.strip, lines))
-        if '' in lines:
-            pos = lines.index ('')
-            lines = lines[pos+1:]
+        # no blank line, so there were no headers to skip
 
-        for line in lines:
+        for line in header:
             f.write(line + '\n')
+        f.close()
+
+        if reader.getCode() == 304:
+            os.remove(tempPath)
+            print("%s file is up to date" % filePath)
+            return
+
+        if reader.getCode() != 200:
+            raise IOError('HTTP status %s' % reader.getCode())
+
+        # keep the permissions of the file we are replacing
+
+        if os.path.exists(filePath):
+            os.chmod(tempPath, os.stat(filePath).st_mode & 0o777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tempPath, 0o666 & ~umask)
+        os.replace(tempPath, filePath)
+        writeValidators(filePath, reader)
         print("Updated %s file" % filePath)
+
+    except IOError as error:
+        print("Errors occurred when reading from webshare product:")
+        print("    " + str(error))
+        print("Error generating data/webshare.rcd file; please try again.")
         f.close()
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        sys.exit(1)
 
     except:
         print("Error generating data/webshare.rcd file; please try again.")
         f.close()
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
         sys.exit(1)
 
 #